@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Runs the fit_mapping procedure over many capture directories in parallel.
+## Each directory must contain the 'kinect.mat' and 'img.png' files, and may
+## also contain a 'bbox.txt' with the crop region and a 'pose.txt' with the
+## camera translation and rotation quaternion (three values each). Without a
+## 'bbox.txt' the page is found automatically. The model and dewarped image
+## are written into the same directory. With BATCH_SPREAD=1 each capture is
+## taken as an open book, and the models of the two pages are written to
+## 'model_0.txt' and 'model_1.txt'.
+
+import os
+import sys
+
+## Each worker runs a single BLAS thread by default, otherwise the processes
+## fight over the cores. This must be set before numpy is loaded.
+blas_threads = os.environ.get('BATCH_BLAS_THREADS', '1')
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+            'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+  os.environ[var] = blas_threads
+
+import glob
+import multiprocessing
+import signal
+import time
+import traceback
+
+from fit_mapping import *
+
+
+class JobTimeout(Exception):
+  pass
+
+def raise_timeout(signum, frame):
+  raise JobTimeout()
+
+## Default camera pose, from paul_data/110307-094958.
+default_pose = array([-0.05655333,  0.01912933, -0.15601968,
+                      0.00333867, -0.00544789, -0.02172069])
+
+def process_capture(data_path, Nl=7, Nk=9, mesh_scale=0.022, Gamma=0.5,
+                    sub=None, output_resolution=200, spread=False):
+  '''Preprocesses the disparity image of one capture, fits the surface model
+  and dewarps the camera image, like fit_mapping does. The disparity image is
+  pooled by sub, or by the largest factor that keeps the points within a
+  quarter of mesh_scale if sub is None. If spread is True the capture is
+  taken as a two-page spread, split at the spine, and one Nl x Nk model is
+  fitted to each page. The dewarped pages are then placed side by side.
+  Returns the list of fit_icp info of each page.'''
+  disparity = load_disparity(os.path.join(data_path, 'kinect.mat'))
+  optical_center = .5*(1+array([disparity.shape[1], disparity.shape[0]]))
+  mypar = IntrinsicParameters(640, optical_center)
+
+  bbox_file = os.path.join(data_path, 'bbox.txt')
+  bbox = loadtxt(bbox_file).astype(int) if os.path.exists(bbox_file) else None
+  pose_file = os.path.join(data_path, 'pose.txt')
+  pose = loadtxt(pose_file) if os.path.exists(pose_file) else default_pose
+
+  sqmesh = SquareMesh(disparity, mypar)
+  ## The two pages of a spread are not on the same plane, and dip at the
+  ## spine, so their region is found with a larger tolerance.
+  sqmesh.crop(bbox, tolerance=0.08 if spread else 0.03)
+  if sub is None:
+    sub = sqmesh.pooling_for_spacing(mesh_scale / 4)
+  sqmesh.pool(sub)
+
+  pages = sqmesh.split_spread() if spread else [sqmesh]
+  for page in pages:
+    page.calculate_xyz_points()
+  ## The pages are fitted one after the other, since the other processes
+  ## already take the remaining cores.
+  surfs, infos = zip(*fit_pages(pages, Nl, Nk, mesh_scale, Gamma, threads=1))
+  for k, surf in enumerate(surfs):
+    name = 'model_%d.txt' % k if spread else 'model.txt'
+    savetxt(os.path.join(data_path, name), surf.pl0)
+
+  cam_ext = ExtrinsicParameters(pose[:3], quaternion_to_matrix(pose[3:]))
+  cam_shot_pil = Image.open(os.path.join(data_path, 'img.png'))
+  cam_shot_pil = cam_shot_pil.transpose(Image.ROTATE_270)
+  c_copt = array([cam_shot_pil.size[0]/2., cam_shot_pil.size[1]/2.])
+  cam_int = IntrinsicParameters(86/.009, c_copt)
+
+  dewarped = []
+  for surf in surfs:
+    rs = project_into_camera(surf.coordinates(), cam_int, cam_ext)
+    dewarped.append(dewarp_image(cam_shot_pil, rs, Nl, Nk, output_resolution))
+  stitch_images(dewarped).save(os.path.join(data_path, 'dewarped.png'))
+  return list(infos)
+
+def run_job(args):
+  '''Worker entry point. Returns a dictionary with the capture, the status
+  ('ok', 'timeout' or 'error'), elapsed time, the fit_icp info of each page
+  and the number of pages done.'''
+  data_path, timeout, kwargs = args
+  t0 = time.time()
+  result = {'data_path': data_path, 'status': 'ok', 'info': None, 'pages': 0}
+  ## The alarm interrupts the job inside the worker, so a stuck fit does not
+  ## hold the process for the rest of the batch.
+  if timeout is not None:
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(int(ceil(timeout)))
+  try:
+    result['info'] = process_capture(data_path, **kwargs)
+    result['pages'] = len(result['info'])
+  except JobTimeout:
+    result['status'] = 'timeout'
+  except Exception:
+    result['status'] = 'error'
+    result['error'] = traceback.format_exc()
+  finally:
+    if timeout is not None:
+      signal.alarm(0)
+  result['time'] = time.time() - t0
+  return result
+
+def expand_paths(patterns):
+  '''Expands the glob patterns, keeping the directories in the given order.'''
+  paths = []
+  for pattern in patterns:
+    paths += sorted(p for p in glob.glob(pattern) if os.path.isdir(p))
+  return paths
+
+def run_batch(data_paths, processes=None, timeout=300, **kwargs):
+  '''Processes the captures over a pool of processes. Returns the list of job
+  results, and a summary with the number of captures done, failed and timed
+  out, the number of pages done, which is two for each spread, the
+  wall-clock time and the throughput in pages per minute.'''
+  t0 = time.time()
+  jobs = [(data_path, timeout, kwargs) for data_path in data_paths]
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = []
+    for result in pool.imap_unordered(run_job, jobs):
+      print '%s: %s (%.1fs)' % (result['data_path'], result['status'],
+                                result['time'])
+      results.append(result)
+  finally:
+    pool.close()
+    pool.join()
+
+  elapsed = time.time() - t0
+  pages = sum(r['pages'] for r in results)
+  summary = {'captures': sum(r['status'] == 'ok' for r in results),
+             'pages': pages,
+             'errors': sum(r['status'] == 'error' for r in results),
+             'timeouts': sum(r['status'] == 'timeout' for r in results),
+             'time': elapsed,
+             'pages_per_minute': 60. * pages / elapsed}
+  return results, summary
+
+###############################################################################
+##
+##
+if __name__ == '__main__':
+  if len(sys.argv)<2:
+    raise Exception('''Incorrect number of parameters.
+
+Usage: %s <data_path or glob> [<data_path or glob> ...]'''%(sys.argv[0]))
+
+  data_paths = expand_paths(sys.argv[1:])
+  processes = int(os.environ.get('BATCH_PROCESSES', multiprocessing.cpu_count()))
+  spread = os.environ.get('BATCH_SPREAD', '0') == '1'
+  results, summary = run_batch(data_paths, processes, spread=spread)
+
+  for result in results:
+    if result['status'] == 'error':
+      print 'Error in %s:\n%s' % (result['data_path'], result['error'])
+  print ('%(captures)d captures (%(pages)d pages), %(errors)d errors, '
+         '%(timeouts)d timeouts in %(time).1fs, %(pages_per_minute).1f pages '
+         'per minute' % summary)
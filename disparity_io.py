@@ -0,0 +1,103 @@
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Loading of disparity images. The Kinect produces 11-bit values, so they are
+## kept as uint16. Binary files are memory-mapped in copy-on-write mode, so
+## they are only read as needed and can still be modified in memory, e.g. by
+## SquareMesh.smash. Text files are parsed once, and a .npy copy is written
+## beside them to be mapped in the next runs.
+
+import os
+
+from numpy import *
+
+import Image
+
+## Shape of a raw Kinect frame, in lines and columns.
+kinect_shape = (480, 640)
+
+def detect_format(filename):
+  '''Guesses the format of a disparity file from its first bytes. Returns
+  'npy', 'png', 'text' or 'raw'.'''
+  f = open(filename, 'rb')
+  head = f.read(512)
+  f.close()
+  if head.startswith('\x93NUMPY'):
+    return 'npy'
+  if head.startswith('\x89PNG'):
+    return 'png'
+  if head.lower().translate(None, '0123456789.-+einaf \t\r\n') == '':
+    return 'text'
+  return 'raw'
+
+def sidecar_filename(filename):
+  return filename + '.npy'
+
+def load_disparity(filename, shape=kinect_shape, cache=True):
+  '''Loads a disparity image as a uint16 array. Text files such as kinect.mat
+  or disparity.txt, .npy files, PNG16 images and raw dumps of little-endian
+  16-bit values are accepted. Raw files have no header, so their shape must
+  be given. If cache is True, text files get a binary sidecar that is used
+  instead of them while it is newer.'''
+  fmt = detect_format(filename)
+
+  if fmt == 'npy':
+    return as_uint16(load(filename, mmap_mode='c'))
+
+  if fmt == 'raw':
+    return memmap(filename, dtype='<u2', mode='c', shape=shape)
+
+  if fmt == 'png':
+    ## 16-bit PNG files are opened by PIL in one of its 32-bit integer modes.
+    return checked_uint16(asarray(Image.open(filename)), filename)
+
+  sidecar = sidecar_filename(filename)
+  if (cache and os.path.exists(sidecar) and
+      os.path.getmtime(sidecar) >= os.path.getmtime(filename)):
+    return as_uint16(load(sidecar, mmap_mode='c'))
+
+  disparity = checked_uint16(loadtxt(filename), filename)
+  if not cache:
+    return disparity
+  ## Write into a temporary file first, so parallel readers never see a
+  ## partially written sidecar. The cache is optional, so if it cannot be
+  ## written, e.g. in a read-only directory, the parsed array is returned.
+  tmpname = sidecar[:-4] + '.%d.tmp.npy' % os.getpid()
+  try:
+    save(tmpname, disparity)
+    os.rename(tmpname, sidecar)
+  except (IOError, OSError):
+    if os.path.exists(tmpname):
+      os.remove(tmpname)
+    return disparity
+  return load(sidecar, mmap_mode='c')
+
+def checked_uint16(values, filename):
+  '''Converts the values read from a file to uint16. Raises ValueError if
+  any of them is not an integer from 0 to 65535, instead of letting the
+  conversion truncate or wrap them.'''
+  if values.dtype == uint16:
+    return values
+  rounded = rint(values)
+  bad = ~((rounded == values) & (values >= 0) & (values <= 65535))
+  if bad.any():
+    raise ValueError('%s: %d values are not valid disparities, e.g. %r' %
+                     (filename, bad.sum(), values[bad][0]))
+  return rounded.astype(uint16)
+
+def as_uint16(disparity):
+  '''Returns the array itself if it is already uint16, or a converted copy.'''
+  if disparity.dtype == uint16:
+    return disparity
+  return disparity.astype(uint16)
@@ -19,6 +19,7 @@ from pylab import *
 from color_block import gucci_dict
 
 from fit_mapping import IntrinsicParameters, ExtrinsicParameters, PinholeCamera, quaternion_to_matrix
+from disparity_io import load_disparity
 
 ###############################################################################
 ##
@@ -49,7 +50,7 @@ Usage: %s <data_path>'''%(sys.argv[0]))
 
   if paul_data:
     ## Load the image with the disparity values. E.g., the range data produced by Kinect.
-    disparity = loadtxt(data_path+'kinect.mat')
+    disparity = load_disparity(data_path+'kinect.mat')
     #disparity = rot90(loadtxt(data_path+'kinect.mat'),2)
 
     k_f = 640
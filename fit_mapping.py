@@ -16,12 +16,17 @@
 from pylab import *
 from fit_cone import *
 from opt_lagrange import *
+from flatten_mesh import flatten_mesh
+from disparity_io import load_disparity
 
 from  scipy.optimize import leastsq, fmin, fmin_powell
 import scipy.interpolate
+import scipy.sparse
 import scipy.ndimage
 import sys
 import itertools
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import Image # For the quad transformation
 
@@ -32,20 +37,6 @@ from color_block import gucci_dict
 import pdb
 
 
-def fitfunc(u, M):
-  Ned = (M.shape[1]-3)/2
-  R = zeros(Ned+3)
-  D = dot(u,M)**2
-  R[:Ned] = D[0:-3:2]+D[1:-3:2]
-  R[-3:] = D[-3:]
-  return R
-
-def devfunc(u, M):
-  return 2*dot(u,M)
-
-errfunc = lambda u, M, d_x: fitfunc(u, M) - d_x
-
-
 def distance_from_disparity(d):
   z = zeros(d.shape, dtype=float)
   ## "identity" version
@@ -57,6 +48,61 @@ def distance_from_disparity(d):
   return 348.0 / (1091.5 - d)
   # return d
 
+class DisparityModel:
+  '''Converts disparities into distances with the given function. Integer
+  disparities, like the 11-bit Kinect values, can only take nvalues different
+  values, so the function is evaluated once for each of them, and frames are
+  converted with a lookup table. For uint8 and uint16 frames the table covers
+  every possible value. The invalid value, and integers from nvalues up or
+  negative, are mapped to NaN. Other disparities go through the function
+  itself.'''
+  def __init__(self, function=distance_from_disparity, nvalues=2048,
+               invalid=2047):
+    self.function = function
+    self.nvalues = nvalues
+    self.invalid = invalid
+    self.tables = {}
+
+  def table(self, dtype=float64, size=None, first=0):
+    ## The distance of the disparities first to first+size-1, at least
+    ## nvalues of them by default. Disparities without a value are NaN.
+    size = size or self.nvalues
+    if size < self.nvalues - first:
+      size = self.nvalues - first
+    key = (dtype, size, first)
+    if key not in self.tables:
+      lut = empty(size, dtype=dtype)
+      lut.fill(nan)
+      lut[-first:self.nvalues - first] = self.function(
+        arange(self.nvalues, dtype=float64))
+      if self.invalid is not None:
+        lut[self.invalid - first] = nan
+      self.tables[key] = lut
+    return self.tables[key]
+
+  def __call__(self, d, dtype=float64):
+    d = asarray(d)
+    if d.dtype.kind == 'u' and d.dtype.itemsize <= 2:
+      ## The table covers every value of the type, so a single take does the
+      ## whole conversion.
+      return self.table(dtype, 2**(8 * d.dtype.itemsize)).take(d)
+    if d.dtype.kind in 'ui':
+      ## Other integers are clipped into a table with a NaN at each end.
+      index = add(d, 1, dtype=intp, casting='unsafe')
+      return self.table(dtype, self.nvalues + 2, -1).take(index, mode='clip')
+    return asarray(self.function(d), dtype=dtype)
+
+  def in_range(self, d):
+    '''Which of the disparities d are covered by the table. Values that are
+    not integers are always in range.'''
+    d = asarray(d)
+    if d.dtype.kind not in 'ui':
+      return ones(d.shape, dtype=bool)
+    return (d >= 0) & (d < self.nvalues)
+
+## Model used by default by all IntrinsicParameters objects.
+kinect_disparity = DisparityModel()
+
 
 class ExtrinsicParameters:
   def __init__(self, T, R):
@@ -74,41 +120,69 @@ class ExtrinsicParameters:
     #self.R = dot(dot(R_theta, R_phi), R_psi).T
 
 class IntrinsicParameters:
-  def __init__(self, f, center):
+  ## Number of ray grids kept by ray_grid.
+  max_rays = 4
+
+  def __init__(self, f, center, disparity_model=kinect_disparity):
     self.f = f
     self.center = center
-
-  def subsample(self, sub):
+    self.disparity_model = disparity_model
+    ## Ray grids from ray_grid, for each image shape and dtype, oldest first.
+    self.rays = OrderedDict()
+
+  def subsample(self, sub, offset=0.):
+    ## New parameters for an image where each pixel is made from sub x sub
+    ## pixels of this one. offset is the position of the new pixel inside its
+    ## block, 0 for strided sampling and (sub-1)/2. for pooling.
     self.f /= sub
-    self.center /= sub
+    self.center = (self.center - offset) / sub
+    self.rays.clear()
+
+  def copy(self):
+    return IntrinsicParameters(self.f, array(self.center, dtype=float),
+                               self.disparity_model)
 
   def crop(self, bbox):
     self.center -= array([bbox[0], bbox[1]])
-
-  ## The magical formula that gives distance form the disparity. This is the
-  ## theoretical perfect model, a x**-1 expression.
-  def distance_from_disparity(self, d):
-    return distance_from_disparity(d)
-
-  def coordinates_from_disparity(self, disparity):
-    ## Calculate the world coordinates of each pixel.
+    self.rays.clear()
+
+  def ray_grid(self, shape, dtype=float64):
+    ## Direction of the ray through each pixel of an image with the given
+    ## shape, scaled to have z=1, so that the coordinates of a pixel are just
+    ## its ray times its distance. The last max_rays grids are kept until the
+    ## camera changes.
+    key = (tuple(shape), self.f, tuple(self.center), dtype)
+    if key not in self.rays:
+      Nl, Nk = shape
+      rays = ones((Nl*Nk, 3), dtype=dtype)
+      rays[:,:2] = (mgrid[:Nk,:Nl].T.reshape(-1,2) - self.center) / self.f
+      while len(self.rays) >= self.max_rays:
+        self.rays.popitem(last=False)
+      self.rays[key] = rays
+    return self.rays[key]
+
+  ## The magical formula that gives distance form the disparity. By default
+  ## this is the theoretical perfect model, a x**-1 expression.
+  def distance_from_disparity(self, d, dtype=float64):
+    return self.disparity_model(d, dtype)
+
+  def coordinates_from_disparity(self, disparity, dtype=float64, out=None,
+                                 index=None):
+    ## Calculate the world coordinates of each pixel, or only of the pixels
+    ## in index, given in line order. The result can be written into an
+    ## existing array given as out, to avoid allocating a new one for each
+    ## frame.
 
     assert disparity.shape > 1
-    Nl = disparity.shape[0]
-    Nk = disparity.shape[1]
+    rays = self.ray_grid(disparity.shape[:2], dtype)
+    d = disparity.ravel()
+    if index is not None:
+      rays = rays[index]
+      d = d[index]
 
-    ## Initialize the output matrix with pixel coordinates over image plane, on
-    ## camera reference frame.
-    output = zeros((Nl*Nk, 3))
-    output[:,:2] = mgrid[:Nk,:Nl].T.reshape(-1,2) - self.center
-    output[:,2] = self.f
-
-    ## Calculate z from disparity
-    z = self.distance_from_disparity(disparity.ravel())
-    output[:,0] *= z / self.f
-    output[:,1] *= z / self.f
-    output[:,2] = z
-    return output
+    ## Calculate z from disparity, and scale the rays.
+    z = self.distance_from_disparity(d, dtype)
+    return multiply(rays, z[:,newaxis], out)
 
   def coordinates_from_xy_disparity(self, xy, disparity):
     ## Calculate the world coordinates of each pixel.
@@ -128,6 +202,93 @@ class IntrinsicParameters:
     output[:,2] = z
     return output
 
+def pool_disparity(disparity, valid, sub, method='mean', invalid=2047):
+  '''Reduces a disparity image by sub in each direction, taking the mean or
+  the median of the valid pixels in each sub x sub block. Lines and columns
+  that do not fill a block are dropped. Returns the float32 disparity and the
+  valid mask of the new image, where the blocks without any valid pixel are
+  invalid.'''
+  Nl, Nk = disparity.shape[0] / sub, disparity.shape[1] / sub
+  ## Put the pixels of each block along the last axis.
+  blocks = disparity[:Nl*sub,:Nk*sub].reshape(Nl, sub, Nk, sub)
+  blocks = blocks.transpose(0, 2, 1, 3).reshape(Nl, Nk, sub*sub)
+  mask = valid[:Nl*sub,:Nk*sub].reshape(Nl, sub, Nk, sub)
+  mask = mask.transpose(0, 2, 1, 3).reshape(Nl, Nk, sub*sub)
+  count = mask.sum(2)
+
+  if method == 'mean':
+    total = where(mask, blocks, 0).sum(2, dtype=float64)
+    pooled = total / maximum(count, 1)
+  elif method == 'median':
+    ## Invalid pixels go to the end of each sorted block, and the median is
+    ## taken from the valid ones at the start.
+    values = sort(where(mask, blocks.astype(float32), inf), 2)
+    lo = maximum(count - 1, 0) / 2
+    hi = count / 2
+    l, k = mgrid[:Nl,:Nk]
+    pooled = (values[l,k,lo] + values[l,k,minimum(hi, sub*sub-1)]) / 2
+  else:
+    raise ValueError('Unknown pooling method: %s' % method)
+
+  new_valid = count > 0
+  pooled = where(new_valid, pooled, invalid).astype(float32)
+  return pooled, new_valid
+
+def find_page_region(disparity, valid, intparam, tolerance=0.03, iterations=3,
+                     max_samples=2000, margin=2):
+  '''Finds the page in a disparity image. A plane is fitted with
+  estimate_normal to the points in the middle third of the image that are
+  closer than tolerance to their median distance, and then fitted again to
+  all the points closer than tolerance to the plane, a few times.
+  The points near the final plane are split into connected regions, and the
+  page is the region with most pixels in the middle of the image. Returns the
+  bounding box of the region, in the format used by SquareMesh.crop and with
+  margin pixels added around it, and the mask of the region.'''
+  Nl, Nk = disparity.shape
+  index = flatnonzero(valid)
+  xyz = intparam.coordinates_from_disparity(disparity, index=index)
+
+  l, k = index / Nk, index % Nk
+  middle = ((l >= Nl / 3) & (l < 2 * Nl / 3) &
+            (k >= Nk / 3) & (k < 2 * Nk / 3))
+  inliers = middle & (abs(xyz[:,2] - median(xyz[middle,2])) < tolerance)
+  for it in range(iterations):
+    ## The fit is made over a strided sample of the points, because the SVD
+    ## in estimate_normal grows with the square of the number of points.
+    sample = xyz[inliers][::max(1, inliers.sum() / max_samples)]
+    rho, n = fit_cone(sample)
+    inliers = abs(dot(xyz, n) - rho) < tolerance
+
+  mask = zeros(Nl * Nk, dtype=bool)
+  mask[index[inliers]] = True
+  mask = mask.reshape(Nl, Nk)
+
+  labels, nlabels = scipy.ndimage.label(mask)
+  if nlabels == 0:
+    return (0, 0, Nk, Nl), valid
+  counts = bincount(labels[Nl/3:2*Nl/3,Nk/3:2*Nk/3].ravel(),
+                    minlength=nlabels + 1)
+  counts[0] = 0
+  mask = labels == argmax(counts)
+
+  lines = flatnonzero(mask.any(1))
+  columns = flatnonzero(mask.any(0))
+  bbox = (max(columns[0] - margin, 0), max(lines[0] - margin, 0),
+          min(columns[-1] + 1 + margin, Nk), min(lines[-1] + 1 + margin, Nl))
+  return bbox, mask
+
+def find_spine(disparity, valid, intparam, margin=0.2, width=5):
+  '''Finds the spine of an open book, as the column where the pages are
+  farthest from the camera. The mean distance of the valid pixels of each
+  column is smoothed over width columns, and the farthest column is searched
+  away from the margin fraction of columns at each side.'''
+  Nk = disparity.shape[1]
+  z = where(valid, intparam.distance_from_disparity(disparity), 0)
+  depth = z.sum(0) / maximum(valid.sum(0), 1)
+  depth = scipy.ndimage.uniform_filter1d(depth, width)
+  first, last = int(margin * Nk), int((1 - margin) * Nk)
+  return first + argmax(depth[first:last])
+
 ###############################################################################
 ## Pinhole camera model. Just a structure with internal and external
 ## parameters. Has a method that calculates image projections.
@@ -185,77 +346,144 @@ class PinholeCamera:
 ## coordinates (camera space, i.e. the input image to be dewarped).
 ##
 class SquareMesh:
-  def __init__(self, disparity, intparam):
+  def __init__(self, disparity, intparam, invalid=2047):
     self.disparity = disparity
     self.intparam = intparam
-
-  def calculate_xyz_points(self):
-    ## Calculate the coordinate values.
-    self.xyz = self.intparam.coordinates_from_disparity(self.disparity)
+    ## Pixels with a valid reading. This is kept along the crops and
+    ## subsamplings, and only these pixels become points.
+    self.valid = ((disparity != invalid) &
+                  intparam.disparity_model.in_range(disparity))
+    ## Pixel of each point, set by calculate_xyz_points.
+    self.pixel_index = None
+
+  def calculate_xyz_points(self, valid_only=True):
+    ## Calculate the coordinate values of the valid pixels, or of all of them
+    ## if valid_only is False. pixel_index holds the pixel of each point.
+    if valid_only:
+      self.pixel_index = flatnonzero(self.valid)
+    else:
+      self.pixel_index = arange(self.disparity.size)
+    self.xyz = self.intparam.coordinates_from_disparity(
+      self.disparity, index=self.pixel_index)
+
+  def point_index(self):
+    ## The point of each pixel, -1 for pixels without a point. Before
+    ## calculate_xyz_points every pixel is its own point.
+    itype = int32 if self.disparity.size < 2**31 else int64
+    if self.pixel_index is None:
+      return arange(self.disparity.size, dtype=itype)
+    lookup = -ones(self.disparity.size, dtype=itype)
+    lookup[self.pixel_index] = arange(self.pixel_index.shape[0])
+    return lookup
 
   def generate_xyz_mesh(self):
-    ## Calculate the connections.
+    ## Calculate the connections. Each pixel connects to the same-line pixel
+    ## to the right, and to any of the three 8-neighbours below, in this
+    ## order. The indices use the smallest signed type that fits the mesh.
+    ## The connections are made between the points from calculate_xyz_points,
+    ## so pixels without a point are left out.
     Nl,Nk = self.disparity.shape
-    Ncon = 4 * (Nk - 1) * (Nl - 1) + Nk + Nl - 2
-    self.con = zeros((Ncon,2), dtype=uint16)
-    ## Loop through every pixel. Add connections when possible. Just either the
-    ## same-line pixel to the right, or any of the three 8-neighbours below.
-    i=0
-    for p in range(Nl*Nk):
-      ## If it's not in the last column, connect to right.
-      if (p + 1) % Nk:
-        self.con[i,0] = p
-        self.con[i,1] = p+1
-        i += 1
-      ## If it not in the last line
-      if p <  Nk * (Nl - 1):
-        ## Connect to the point below
-        self.con[i,0] = p
-        self.con[i,1] = p+Nk
-        i += 1
-        ## If it's not in the first column, connect to lower left.
-        if p % Nk:
-          self.con[i,0] = p
-          self.con[i,1] = p+Nk-1
-          i += 1
-        ## If it's not in the last column, connect to lower right.
-        if (p + 1) % Nk:
-          self.con[i,0] = p
-          self.con[i,1] = p+Nk+1
-          i += 1
+    itype = int32 if Nl * Nk < 2**31 else int64
+    l, k = mgrid[:Nl,:Nk].reshape(2,-1)
+    p = arange(Nl*Nk, dtype=itype)
+
+    ## Candidate neighbours of each pixel, and which of them exist.
+    right, below = (k < Nk - 1), (l < Nl - 1)
+    targets = c_[p+1, p+Nk, p+Nk-1, p+Nk+1]
+    valid = c_[right, below, below & (k > 0), below & right]
+    con = c_[repeat(p, valid.sum(1)), targets[valid]]
 
     ## Connections for a square emsh (mostly for plotting)
-    Nsqcon = 2 * Nk * Nl - Nl -Nk
-    self.sqcon = zeros((Nsqcon,2), dtype=uint16)
-    ## Loop through every pixel. Add connections when possible. Just either the
-    ## same-line pixel to the right, or any of the three 8-neighbours below.
-    i=0
-    for p in range(Nl*Nk):
-      ## If it's not in the last column, connect to right.
-      if (p + 1) % Nk:
-        self.sqcon[i,0] = p
-        self.sqcon[i,1] = p+1
-        i += 1
-      ## If it not in the last line
-      if p <  Nk * (Nl - 1):
-        ## Connect to the point below
-        self.sqcon[i,0] = p
-        self.sqcon[i,1] = p+Nk
-        i += 1
+    valid = valid[:,:2]
+    sqcon = c_[repeat(p, valid.sum(1)), targets[:,:2][valid]]
+
+    ## Change into point indices, keeping the connections with both ends.
+    lookup = self.point_index()
+    con = lookup[con]
+    self.con = con[(con >= 0).all(1)]
+    sqcon = lookup[sqcon]
+    self.sqcon = sqcon[(sqcon >= 0).all(1)]
+
+  def adjacency(self, square=False):
+    ## The connections as a symmetric scipy.sparse CSR adjacency matrix, from
+    ## con or from sqcon if square is True.
+    con = self.sqcon if square else self.con
+    Np = self.xyz.shape[0]
+    rows = r_[con[:,0], con[:,1]]
+    cols = r_[con[:,1], con[:,0]]
+    return scipy.sparse.csr_matrix((ones(rows.shape[0]), (rows, cols)),
+                                   shape=(Np, Np))
 
   def subsample(self, sub):
     self.disparity = self.disparity[::sub,::sub]
+    self.valid = self.valid[::sub,::sub]
     self.intparam.subsample(sub)
 
-  def crop(self, bbox):
+  def pool(self, sub, method='mean'):
+    ## Reduces the image like subsample, but each new pixel is the mean or
+    ## median of the valid pixels in its block, see pool_disparity.
+    if sub == 1:
+      return
+    self.disparity, self.valid = pool_disparity(self.disparity, self.valid,
+                                                sub, method)
+    self.intparam.subsample(sub, (sub - 1) / 2.)
+
+  def pyramid(self, levels, method='mean'):
+    ## Returns a list of new meshes, where the image of level i is pooled by
+    ## 2**i. The camera parameters of each level are copied.
+    meshes = []
+    for i in range(levels):
+      mesh = SquareMesh(self.disparity, self.intparam.copy())
+      mesh.valid = self.valid
+      mesh.pool(2**i, method)
+      meshes.append(mesh)
+    return meshes
+
+  def split_spread(self, overlap=0, **kwargs):
+    ## Splits the image of a two-page spread at the spine found by find_spine,
+    ## returning one new mesh for the left columns and another one for the
+    ## right columns, sharing overlap columns at each side of the spine.
+    Nl, Nk = self.disparity.shape
+    self.spine = find_spine(self.disparity, self.valid, self.intparam,
+                            **kwargs)
+    pages = []
+    for bbox in [(0, 0, min(self.spine + overlap, Nk), Nl),
+                 (max(self.spine - overlap, 0), 0, Nk, Nl)]:
+      page = SquareMesh(self.disparity, self.intparam.copy())
+      page.valid = self.valid
+      page.crop(bbox)
+      pages.append(page)
+    return pages
+
+  def pooling_for_spacing(self, spacing, max_sub=16):
+    ## The largest power of two pooling where the pixels are still no more
+    ## than spacing apart over the surface, at the median distance of the
+    ## valid pixels. The number of points of each level is about
+    ## valid.sum() / sub**2.
+    z = median(self.intparam.distance_from_disparity(self.disparity[self.valid]))
+    sub = 1
+    while sub * 2 <= max_sub and z * sub * 2 / self.intparam.f <= spacing:
+      sub *= 2
+    return sub
+
+  def crop(self, bbox=None, **kwargs):
+    ## bbox is (left, top, right, bottom) in pixels. If it is not given, the
+    ## page is found with find_page_region, and the pixels outside the page
+    ## are also marked as invalid.
+    if bbox is None:
+      bbox, mask = find_page_region(self.disparity, self.valid, self.intparam,
+                                    **kwargs)
+      self.valid = self.valid & mask
+    self.bbox = bbox
     self.disparity = self.disparity[bbox[1]:bbox[3],bbox[0]:bbox[2]]
+    self.valid = self.valid[bbox[1]:bbox[3],bbox[0]:bbox[2]]
     self.intparam.crop(bbox)
 
   def smash(self):
     ## Deal with outliers, just look for the maximum value outside of the
-    ## maximum possible, then make the outliers the same. The better procedures
-    ## would be to either fill the hole with the surrounding values, or simply
-    ## discard these values during the optimization.
+    ## maximum possible, then make the outliers the same. The invalid pixels
+    ## are now discarded using the valid mask, so this is only needed when all
+    ## the pixels must become points.
     self.disparity[self.disparity==2047] = self.disparity[self.disparity<2047].max()
 
   ## This run_optimization method runs a draft of an optimization procedure
@@ -264,52 +492,215 @@ class SquareMesh:
   ## fitting will now be performed inside a separate class, and this one will
   ## merely provide the data to it: the "reconstructed" xyz point cloud.
   def run_optimization(self):
-    ## Find the "middle" point to make it the origin, and make it.
+    ## Find the "middle" point to make it the origin, and make it. This is the
+    ## first point from the middle pixel on, in case it is not valid.
     self.mp = (self.disparity.shape[0]/2) * self.disparity.shape[1] + self.disparity.shape[1]/2
+    self.mp = min(searchsorted(self.pixel_index, self.mp),
+                  self.pixel_index.shape[0] - 2)
     ## Set the initial estimate from the original xy coordinates, subtracting by the location of the middle point
-    self.u0 = reshape(self.xyz[:,:2] - self.xyz[self.mp,:2] ,-1)
-
-    ## Start to set up optimization stuff
-    Np = self.xyz.shape[0] #disparity.shape[0] * disparity.shape[1]
-    Ned = self.con.shape[0]
-
-    print Np, Ned
-
-    M = zeros((2*Np, 2*Ned+3))
-    d_x = zeros(Ned+3)
+    self.u0 = self.xyz[:,:2] - self.xyz[self.mp,:2]
 
-    for i in range(Ned):
-      a,b = self.con[i]
+    print self.xyz.shape[0], self.con.shape[0]
 
-      M[a*2,2*i] = 1
-      M[b*2,2*i] = -1
-      M[a*2+1,2*i+1] = 1
-      M[b*2+1,2*i+1] = -1
-      #d_x[i] = sqrt( ((self.xyz[a] - self.xyz[b]) ** 2 ).sum() )
-      d_x[i] = ( ((self.xyz[a] - self.xyz[b]) ** 2 ).sum() )
+    ## Fit this baby. The middle point stays at the origin, and the next one
+    ## over the u axis.
+    anchors = [2*self.mp, 2*self.mp+1, 2*self.mp+3]
+    self.uv, final_err, info = flatten_mesh(self.xyz, self.con, self.u0,
+                                            anchors)
 
-    ## Find the "middle" point to make it the origin
-    mp = (self.disparity.shape[0]/2) * self.disparity.shape[1] + self.disparity.shape[1]/2
-    M[2*mp,-3] = 1
-    M[2*mp+1,-2] = 1
-    M[2*mp+3,-1] = 1
-
-    mdist = d_x.mean()
-
-    ## Fit this baby
-    uv_opt, success = scipy.optimize.leastsq(errfunc, self.u0, args=(M, d_x,))
-
-    final_err = (errfunc(uv_opt, M, d_x)**2).sum()
-
-    self.uv = reshape(uv_opt,(-1,2))
-
-    return success, final_err
+    return info, final_err
 
 def project_into_camera(xyz, int_param, ext_param):
   xyz_c = dot(xyz - ext_param.T, ext_param.R)
   rs = int_param.center + int_param.f * xyz_c[:,:2] / xyz_c[:,[2,2]]
   return rs
 
+def fit_page(sqmesh, Nl, Nk, mesh_scale, Gamma, offset=array([0.005,0.,0])):
+  '''Fits a new Nl x Nk SurfaceModel to the points of sqmesh, starting from a
+  flat mesh around their mean plus offset. The first fit has no
+  regularization, and a second fit with Gamma refines the correspondences.
+  Returns the model and the information from the last fit_icp.'''
+  surf = SurfaceModel(Nl, Nk)
+  surf.initialize_projection(sqmesh.xyz, sqmesh.disparity.shape,
+                             sqmesh.intparam, window=1,
+                             pixel_index=sqmesh.pixel_index)
+  surf.calculate_initial_guess(mesh_scale, mean(sqmesh.xyz,0) + offset)
+  surf.fit_icp(mesh_scale, 0.0, max_rounds=3, max_time=60)
+  info = surf.fit_icp(mesh_scale, Gamma, max_rounds=10, max_time=120)
+  return surf, info
+
+def fit_pages(sqmeshes, Nl, Nk, mesh_scale, Gamma, threads=None):
+  '''Runs fit_page over each mesh, e.g. the pages from split_spread, at the
+  same time over a pool of threads, one per mesh by default. With a single
+  mesh or thread the fits run in the calling thread. Returns the list of
+  fit_page results.'''
+  fit = lambda m: fit_page(m, Nl, Nk, mesh_scale, Gamma)
+  threads = threads or len(sqmeshes)
+  if threads == 1 or len(sqmeshes) == 1:
+    return [fit(m) for m in sqmeshes]
+  pool = ThreadPool(threads)
+  results = pool.map_async(fit, sqmeshes)
+  pool.close()
+  ## Unlike map, waiting with a timeout can be interrupted by signals, such
+  ## as the alarm from batch_fit. The threads are not joined in that case,
+  ## and they end by themselves after their fit.
+  results = results.get(1e6)
+  pool.join()
+  return results
+
+def stitch_images(images):
+  '''Places the PIL images side by side, in order, over a new image.'''
+  width = sum(im.size[0] for im in images)
+  height = max(im.size[1] for im in images)
+  output = Image.new(images[0].mode, (width, height))
+  left = 0
+  for im in images:
+    output.paste(im, (left, 0))
+    left += im.size[0]
+  return output
+
+def interpolate_grid(grid, t):
+  '''Linear interpolation of the (N, ...) array grid along its first axis,
+  at the fractional indices t, clipped to [0, N-1].'''
+  t = clip(t, 0, grid.shape[0] - 1)
+  i = minimum(t.astype(int), grid.shape[0] - 2)
+  w = (t - i).astype(grid.dtype).reshape((-1,) + (1,) * (grid.ndim - 1))
+  return (1 - w) * grid[i] + w * grid[i + 1]
+
+def dewarp_coordinates(rs, Nl, Nk, output_resolution, lines):
+  '''Source coordinates in the camera image of the given lines of the
+  dewarped image. Output columns follow the first axis of the model grid
+  and output lines the second one, with output_resolution pixels per cell,
+  as in PIL Image.MESH. Inside each cell this is the same bilinear map from
+  the square to the projected quadrilateral, taken at the pixel centers.
+  Returns the camera image line and column of each output pixel, as two
+  (len(lines), output_resolution * (Nl-1)) arrays, with the pixel centers
+  at integer coordinates.'''
+  grid = rs.reshape(Nl, Nk, 2).astype(float32) - 0.5
+  ## The map is bilinear, so it is separable: interpolate along the grid
+  ## lines first, for the output lines, and then along the columns.
+  columns = interpolate_grid(grid.transpose(1, 0, 2),
+                             (lines + 0.5) / output_resolution)
+  x = (arange(output_resolution * (Nl-1)) + 0.5) / output_resolution
+  source = interpolate_grid(columns.transpose(1, 0, 2), x)
+  return source[:,:,1].T, source[:,:,0].T
+
+def pack_pixels(image):
+  '''Packs the 8-bit channels of each pixel of the (H, W, C) array image,
+  with C up to 4, into a single uint32. A border of black pixels is added,
+  one pixel wide at the top and left and two at the bottom and right, so
+  that bilinear_gather never reads outside of the array.'''
+  H, W, C = image.shape
+  packed = zeros((H + 3, W + 3, 4), dtype=uint8)
+  packed[1:H+1,1:W+1,:C] = image
+  return packed.view(uint32)[:,:,0]
+
+def lerp_pixels(p, q, w):
+  '''Linear interpolation between the packed pixels p and q, with weights w
+  from 0 to 255 for q, in 256ths. The channels are taken two at a time,
+  in alternate bytes, so each product still fits in its 16 bits.'''
+  mask = uint32(0x00ff00ff)
+  v = 256 - w
+  low = (((p & mask) * v + (q & mask) * w) >> 8) & mask
+  high = (((p >> 8) & mask) * v + ((q >> 8) & mask) * w) & ~mask
+  return low | high
+
+def bilinear_gather(packed, y, x):
+  '''Samples the pixels from pack_pixels at the lines y and columns x of the
+  original image, with bilinear interpolation. Pixels outside of the image
+  are black.'''
+  H, W = packed.shape[0] - 3, packed.shape[1] - 3
+  ## Fixed point coordinates over the padded image, with 8 fractional bits.
+  ys = ((clip(y, -1, H) + 1) * 256 + 0.5).astype(int32)
+  xs = ((clip(x, -1, W) + 1) * 256 + 0.5).astype(int32)
+  i = (ys >> 8) * (W + 3) + (xs >> 8)
+  wx = (xs & 255).astype(uint32)
+  wy = (ys & 255).astype(uint32)
+  flat = packed.ravel()
+  top = lerp_pixels(flat.take(i), flat.take(i + 1), wx)
+  bottom = lerp_pixels(flat.take(i + W + 3), flat.take(i + W + 4), wx)
+  return lerp_pixels(top, bottom, wy)
+
+def mesh_dewarp(cam_shot_pil, rs, Nl, Nk, output_resolution):
+  '''dewarp_image with PIL Image.MESH, one bilinear quad transform for each
+  cell of the model grid.'''
+  output_size=(output_resolution * (Nl-1), output_resolution * (Nk-1))
+
+  grid_u, grid_v = output_resolution * mgrid[:Nl,:Nk]
+
+  grid_r = rs[:,0].reshape(Nl, Nk)
+  grid_s = rs[:,1].reshape(Nl, Nk)
+
+  map_list = []
+  for j in range(Nl-1):
+    for k in range(Nk-1):
+      u1, v1 = grid_u[j,k], grid_v[j,k]
+      u2, v2 = grid_u[j+1,k+1], grid_v[j+1,k+1]
+      r1, s1 = grid_r[j,k], grid_s[j,k]
+      r4, s4 = grid_r[j+1,k], grid_s[j+1,k]
+      r3, s3 = grid_r[j+1,k+1], grid_s[j+1,k+1]
+      r2, s2 = grid_r[j,k+1], grid_s[j,k+1]
+      map_list.append(((u1,v1,u2,v2), (r1,s1,r2,s2,r3,s3,r4,s4)))
+
+  return cam_shot_pil.transform(output_size, Image.MESH, map_list,
+                                Image.BILINEAR)
+
+def remap_dewarp(cam_shot_pil, rs, Nl, Nk, output_resolution, tile_lines=64,
+                 threads=1):
+  '''dewarp_image with a per-pixel remap. The source coordinates of the
+  output pixels are calculated and sampled with bilinear_gather over tiles
+  of tile_lines lines, in the calling thread, or in a pool of threads if
+  threads is more than 1.'''
+  if cam_shot_pil.mode not in ('L', 'RGB', 'RGBA'):
+    cam_shot_pil = cam_shot_pil.convert('RGB')
+  source = asarray(cam_shot_pil)
+  if source.ndim == 2:
+    source = source[:,:,newaxis]
+  packed = pack_pixels(source)
+
+  height, width = output_resolution * (Nk-1), output_resolution * (Nl-1)
+  output = zeros((height, width), dtype=uint32)
+
+  def dewarp_tile(first):
+    lines = arange(height)[first:first + tile_lines]
+    y, x = dewarp_coordinates(rs, Nl, Nk, output_resolution, lines)
+    output[first:first + tile_lines] = bilinear_gather(packed, y, x)
+
+  tiles = range(0, height, tile_lines)
+  if threads == 1:
+    for first in tiles:
+      dewarp_tile(first)
+  else:
+    ## Waiting with a timeout can be interrupted by signals, see fit_pages.
+    pool = ThreadPool(threads)
+    done = pool.map_async(dewarp_tile, tiles)
+    pool.close()
+    done.get(1e6)
+    pool.join()
+
+  channels = output.view(uint8).reshape(height, width, 4)[:,:,:source.shape[2]]
+  if source.shape[2] == 1:
+    channels = channels[:,:,0]
+  return Image.fromarray(ascontiguousarray(channels), cam_shot_pil.mode)
+
+def dewarp_image(cam_shot_pil, rs, Nl, Nk, output_resolution=200,
+                 method=None, **kwargs):
+  '''Maps each quadrilateral of the model grid projected into the camera
+  image, rs, into a square of output_resolution pixels in the output image,
+  with bilinear interpolation. The method can be 'mesh', for mesh_dewarp, or
+  'remap', for remap_dewarp, which takes the other arguments. PIL spends a
+  fixed time on each quad, so by default the remap is only used when the
+  cells have fewer than 16 pixels on each side, where it is faster. Returns
+  the dewarped PIL image.'''
+  if method is None:
+    method = 'remap' if output_resolution < 16 else 'mesh'
+  if method == 'mesh':
+    return mesh_dewarp(cam_shot_pil, rs, Nl, Nk, output_resolution)
+  elif method == 'remap':
+    return remap_dewarp(cam_shot_pil, rs, Nl, Nk, output_resolution, **kwargs)
+  else:
+    raise ValueError('Unknown dewarping method: %s' % method)
+
 ###############################################################################
 ##
 ##
@@ -350,13 +741,13 @@ Usage: %s <data_path>'''%(sys.argv[0]))
 
   if paul_data:
     ## Load the image with the disparity values. E.g., the range data produced by Kinect.
-    disparity = loadtxt(data_path+'kinect.mat')
+    disparity = load_disparity(data_path+'kinect.mat')
 
     optical_center = .5*(1+array([disparity.shape[1], disparity.shape[0]]))
     f = 640
   else:
     ## Load the image with the disparity values. E.g., the range data produced by Kinect.
-    disparity = loadtxt(data_path+'disparity.txt')
+    disparity = load_disparity(data_path+'disparity.txt')
     ## Load the file with the camera parameters used to render the scene
     ## The values are: [f, p[0], p[1], p[2], theta, phi, psi, k]
     params_file = loadtxt(data_path+'params.txt')
@@ -377,7 +768,9 @@ Usage: %s <data_path>'''%(sys.argv[0]))
   # bbox = (230, 125, 550, 375) #just the book, whole book
 
   ## paul_data/110307-094958
-  bbox = (215, 120, 365, 374)
+  #bbox = (215, 120, 365, 374)
+  ## Find the page automatically
+  bbox = None
   ##paul_data/110307-100158
   #bbox = (173, 142, 300, 350)
   sub = 1
@@ -388,9 +781,9 @@ Usage: %s <data_path>'''%(sys.argv[0]))
   sqmesh = SquareMesh(disparity, mypar)
   ## Cut the image (i.e. segment the book...)
   sqmesh.crop(bbox)
-  ## Resample down the image 'sub' times, and handle outliers
-  sqmesh.subsample(sub)
-  sqmesh.smash()
+  ## Resample down the image 'sub' times, averaging the valid pixels of each
+  ## block. Pixels without a reading are left out of the point cloud.
+  sqmesh.pool(sub)
   ## Generate the 3D point cloud and connection array
   sqmesh.calculate_xyz_points()
 
@@ -415,20 +808,24 @@ Usage: %s <data_path>'''%(sys.argv[0]))
 
   surf = SurfaceModel(Nl, Nk)
 
-  surf.initialize_kdtree(sqmesh.xyz)
+  ## The point cloud comes from the disparity image, so the correspondences can
+  ## be found projecting the model into the image instead of using a kd-tree.
+  use_projection = True
+  if use_projection:
+    surf.initialize_projection(sqmesh.xyz, sqmesh.disparity.shape,
+                               sqmesh.intparam, window=1,
+                               pixel_index=sqmesh.pixel_index)
+  else:
+    surf.initialize_kdtree(sqmesh.xyz)
   surf.calculate_initial_guess(mesh_scale, mean(sqmesh.xyz,0) + array([0.005,0.,0]))
 
   if do_optim:
-    Niter = 1
-    for kk in range(Niter):
-      surf.assign_input_points()
-      surf.fit(mesh_scale, 0.0)
-      savetxt(data_path+'model.txt', surf.pl0)
-    Niter = 2
-    for kk in range(Niter):
-      surf.assign_input_points()
-      surf.fit(mesh_scale, Gamma)
-      savetxt(data_path+'model.txt', surf.pl0)
+    ## First a rough fit without regularization, then the final fit with
+    ## Gamma refines the correspondences. Each ICP stage runs until the model
+    ## stops moving or changing correspondences.
+    print surf.fit_icp(mesh_scale, 0.0, max_rounds=3, max_time=60)
+    print surf.fit_icp(mesh_scale, Gamma, max_rounds=10, max_time=120)
+    savetxt(data_path+'model.txt', surf.pl0)
   else:
     surf.pl0 = loadtxt(data_path+'model.txt')
     surf.assign_input_points()
@@ -463,47 +860,13 @@ Usage: %s <data_path>'''%(sys.argv[0]))
   rs = project_into_camera(surf.coordinates(), cam_int, cam_ext)
 
   ##############################################################################
-  ## Calculate mapping value at grid points for mapping
+  ## Dewarp the camera image using the projection of the model grid.
   output_resolution = 200
-  output_size=(output_resolution * (Nl-1), output_resolution * (Nk-1))
-
-  lims_uv = zeros(4)
-  lims_uv[0] = 0
-  lims_uv[1] = 0
-  lims_uv[2] = (Nk-1) * output_resolution
-  lims_uv[3] = (Nl-1) * output_resolution
-
-  max_uv_range = max(lims_uv[2]-lims_uv[0], lims_uv[3]-lims_uv[1])
-
-  maxNsps = int(1.2 * max(sqmesh.disparity.shape))
-  grid_u, grid_v = output_resolution * mgrid[:Nl,:Nk]
-
-  grid_r = rs[:,0].reshape(Nl, Nk)
-  grid_s = rs[:,1].reshape(Nl, Nk)
-
-  the_mappings = []
-
-  for j in range(grid_u.shape[0]-1):
-    for k in range(grid_u.shape[1]-1):
-      u1, v1 = grid_u[j,k], grid_v[j,k]
-      u2, v2 = grid_u[j+1,k+1], grid_v[j+1,k+1]
-      r1, s1 = grid_r[j,k], grid_s[j,k]
-      r4, s4 = grid_r[j+1,k], grid_s[j+1,k]
-      r3, s3 = grid_r[j+1,k+1], grid_s[j+1,k+1]
-      r2, s2 = grid_r[j,k+1], grid_s[j,k+1]
-      the_mappings.append((u1,v1,u2,v2,r1,s1,r2,s2,r3,s3,r4,s4))
-
-  the_mappings = array(the_mappings)
-
-  the_mappings[:,[0,2]] -= lims_uv[0]
-  the_mappings[:,[1,3]] -= lims_uv[1]
 
   im = Image.open(data_path+'img.png')
   cam_shot_pil = im.transpose(Image.ROTATE_270)
 
-  map_list = [((a[0],a[1],a[2],a[3]), (a[4], a[5], a[6], a[7], a[8], a[9], a[10],a[11])) for a in the_mappings]
-
-  dewarped_image = cam_shot_pil.transform(output_size, Image.MESH, map_list)
+  dewarped_image = dewarp_image(cam_shot_pil, rs, Nl, Nk, output_resolution)
 
   dewarped_image.save('dewarped.png')
 
@@ -525,7 +888,9 @@ Usage: %s <data_path>'''%(sys.argv[0]))
   if plot_wireframe:
     ## Plot wireframe
     ## Split the xyz 3 "channels" into three images with proper shape.
-    x,y,z = [xx.T for xx in sqmesh.xyz.reshape(*(list(sqmesh.disparity.shape)+[3])).T]
+    ## Invalid pixels become NaN.
+    xyz_grid = sqmesh.intparam.coordinates_from_disparity(sqmesh.disparity)
+    x,y,z = [xx.T for xx in xyz_grid.reshape(*(list(sqmesh.disparity.shape)+[3])).T]
 
     ## Get the estimated model coordinates
     p = surf.coordinates()
@@ -539,10 +904,10 @@ Usage: %s <data_path>'''%(sys.argv[0]))
     ax.plot_wireframe(surf.q[:,0].reshape(Nl,Nk),surf.q[:,1].reshape(Nl,Nk),surf.q[:,2].reshape(Nl,Nk), color='g')
     ax.plot_wireframe(p[:,0].reshape(Nl,Nk),p[:,1].reshape(Nl,Nk),p[:,2].reshape(Nl,Nk), color='r')
 
-    mrang = max([x.max()-x.min(), y.max()-y.min(), z.max()-z.min()])/2
-    midx = (x.max()+x.min())/2
-    midy = (y.max()+y.min())/2
-    midz = (z.max()+z.min())/2
+    mrang = max([nanmax(x)-nanmin(x), nanmax(y)-nanmin(y), nanmax(z)-nanmin(z)])/2
+    midx = (nanmax(x)+nanmin(x))/2
+    midy = (nanmax(y)+nanmin(y))/2
+    midz = (nanmax(z)+nanmin(z))/2
 
     ax.set_xlim3d(midx-mrang, midx+mrang)
     ax.set_ylim3d(midy-mrang, midy+mrang)
@@ -556,7 +921,7 @@ Usage: %s <data_path>'''%(sys.argv[0]))
     #grid_y,grid_x = mgrid[,-.14:0:res]
     grid_x = mgrid[-.14:0:res]
     grid_y = mgrid[-.1:.1:res]
-    grid_kin = griddata(x.ravel(), y.ravel(), z.ravel(), grid_x.ravel(), grid_y.ravel(), interp='linear')
+    grid_kin = griddata(sqmesh.xyz[:,0], sqmesh.xyz[:,1], sqmesh.xyz[:,2], grid_x.ravel(), grid_y.ravel(), interp='linear')
     grid_mod = griddata(p[:,0], p[:,1], p[:,2], grid_x.ravel(), grid_y.ravel(), interp='linear')
     # contour(x,y,z)
     # contour(p[:,0].reshape(Nl,Nk),p[:,1].reshape(Nl,Nk),p[:,2].reshape(Nl,Nk))
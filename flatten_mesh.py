@@ -0,0 +1,72 @@
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Isometric flattening of a mesh: find uv coordinates over the plane for each
+## vertex so that the squared lengths of the edges are the same as in 3D.
+
+from pylab import *
+import scipy.sparse
+
+from opt_lagrange import sparse_leastsq
+
+def edge_incidence(con, Np):
+  '''Builds the sparse (Ned, Np) incidence matrix of the edges in con, with
+  +1 at the first point of each edge and -1 at the second, so that
+  D.dot(u) gives the vector along each edge.'''
+  Ned = con.shape[0]
+  rows = repeat(arange(Ned), 2)
+  cols = con.astype(int).ravel()
+  data = tile([1., -1.], Ned)
+  return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(Ned, Np))
+
+def squared_edge_lengths(x, con):
+  '''Squared length of each edge in con, for points x of any dimension.'''
+  return ((x[con[:,0]] - x[con[:,1]])**2).sum(1)
+
+def flattening_residuals(u, D, d_x, anchors):
+  '''The squared length of each edge over the plane minus the target d_x,
+  followed by the anchored coordinates, that must be zero. u holds the (u,v)
+  coordinates of each point, and anchors are the indices into u of the
+  anchored coordinates.'''
+  e = D.dot(u.reshape(-1, 2))
+  return r_[(e**2).sum(1) - d_x, u[anchors]]
+
+def flattening_jacobian(u, D, d_x, anchors):
+  '''Sparse jacobian of flattening_residuals. Each edge line has 2 * e at
+  the first point and -2 * e at the second, where e is the edge vector.'''
+  Ned, Np = D.shape
+  e = D.dot(u.reshape(-1, 2))
+  Dc = D.tocoo()
+  rows = r_[repeat(Dc.row, 2), Ned + arange(len(anchors))]
+  cols = r_[(2 * Dc.col[:,newaxis] + arange(2)).ravel(), anchors]
+  vals = r_[ravel(2 * Dc.data[:,newaxis] * e[Dc.row]), ones(len(anchors))]
+  return scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                 shape=(Ned + len(anchors), 2 * Np))
+
+def flatten_mesh(x, con, u0, anchors, **kwargs):
+  '''Finds the uv coordinates of the points x, connected by the edges in con,
+  that preserve the edge lengths, starting from the (Np, 2) array u0. The
+  anchors are indices into the raveled uv coordinates that are kept at zero,
+  to remove the rigid motions. Other arguments go to sparse_leastsq.
+
+  Returns the (Np, 2) array of uv coordinates, the final sum of squared
+  residuals and the information from sparse_leastsq.'''
+  D = edge_incidence(con, x.shape[0])
+  d_x = squared_edge_lengths(x, con)
+  anchors = array(anchors, dtype=int)
+  args = (D, d_x, anchors)
+  u_opt, info = sparse_leastsq(flattening_residuals, ravel(u0), args=args,
+                               Dfun=flattening_jacobian, **kwargs)
+  final_err = (flattening_residuals(u_opt, *args)**2).sum()
+  return u_opt.reshape(-1, 2), final_err, info
@@ -17,24 +17,11 @@ from pylab import *
 import pdb
 
 from fit_cone import *
+from flatten_mesh import flatten_mesh
 
 from  scipy.optimize import leastsq
 ion()
 
-def fitfunc(u, M):
-  Ned = (M.shape[1]-3)/2
-  R = zeros(Ned+3)
-  D = dot(u,M)**2
-  R[:Ned] = D[0:-3:2]+D[1:-3:2]
-  R[-3:] = D[-3:]
-  return R
-
-def devfunc(u, M):
-  return 2*dot(u,M)
-
-errfunc = lambda u, M, d_x: fitfunc(u, M) - d_x
-
-
 def execute_test(k,tt):
   x = generate_cyl_points(k,tt)
 
@@ -58,39 +45,18 @@ def execute_test(k,tt):
   print 'Np', Np
   print 'Ned', Ned
 
-
-  M = zeros((2*Np, 2*Ned+3))
-  d_x = zeros(Ned+3)
-
-  for i in range(Ned):
-    a,b = con[i]
-
-    M[a*2,2*i] = 1
-    M[b*2,2*i] = -1
-    M[a*2+1,2*i+1] = 1
-    M[b*2+1,2*i+1] = -1
-    d_x[i] = ((x[a]-x[b])**2).sum()
-
-  M[0,-3] = 1
-  M[1,-2] = 1
-  M[3,-1] = 1
-
-  print 'Ms', M.shape
-
-
   ## Start as a square mesh, with first point centered and second over x axis
   # u0 = reshape(x[:,[0,2]]-x[0,[0,2]],-1)
   # u0 = reshape(x[:,[0,2]]-x[0,[0,2]],-1)
-  u0 = reshape(.0+mgrid[0:4,0:4].T,-1)
+  u0 = .0+mgrid[0:4,0:4].T.reshape(-1,2)
   # pdb.set_trace()
 
-  ## Fit this baby
-  u_opt, success = scipy.optimize.leastsq(errfunc, u0, args=(M, d_x,))
-
-  final_err = (errfunc(u_opt, M, d_x)**2).sum()
+  ## Fit this baby, keeping the first point at the origin and the second one
+  ## over the x axis.
+  u_opt, final_err, info = flatten_mesh(x, con, u0, [0, 1, 3])
   print 'final err:', final_err
 
-  return reshape(u0,(-1,2)), reshape(u_opt,(-1,2)), con, final_err
+  return u0, u_opt, con, final_err
 
 if __name__ == '__main__':
   figure(1, figsize=[12,8])
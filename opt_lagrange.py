@@ -25,7 +25,16 @@ from fit_cone import *
 import mpl_toolkits.mplot3d.axes3d as p3
 
 from scipy.optimize import leastsq
-from scipy.spatial import KDTree
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.spatial import KDTree, cKDTree
+import scipy.ndimage
+
+import os
+import threading
+import time
+import warnings
+from collections import OrderedDict
 
 ion()
 
@@ -51,13 +60,14 @@ def sys_eqs(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   ## corresponding restrictions, and each of these has one multiplier.
   l = reshape(pl[3*N:], (N, 3))
 
-  ## Calculate the p derivatives (sum U_j^k p_k^w) into temporary arrays.
-  p_u = dot(U, p)
-  p_v = dot(V, p)
+  ## Calculate the p derivatives (sum U_j^k p_k^w) into temporary arrays. The
+  ## operators may be either dense arrays or scipy.sparse matrices.
+  p_u = U.dot(p)
+  p_v = V.dot(p)
 
   ## Second order derivatives for regularization.
-  p_uu = dot(UU, p)
-  p_vv = dot(VV, p)
+  p_uu = UU.dot(p)
+  p_vv = VV.dot(p)
 
   ## Calculate "residue" function for each coordinate (p - q plus all the
   ## magical lambdas), and calculate the values of the restriction functions.
@@ -67,10 +77,11 @@ def sys_eqs(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   ## gradients of the "g" functions (constraints). The obscure l[:,3*[0]] is a
   ## matrix with the first column of l replicated 3 times.
   h = (p - q
-       + Gamma * (dot(diag(diag(UU)), p_uu) + dot(diag(diag(VV)), p_vv))
-       + (dot(U.T, l[:,3*[0]] * p_u) +
-          dot(V.T, l[:,3*[1]] * p_v) +
-          (dot(U.T, l[:,3*[2]] * p_v) + dot(V.T, l[:,3*[2]] * p_u)) / 2)
+       + Gamma * (UU.diagonal()[:,newaxis] * p_uu +
+                  VV.diagonal()[:,newaxis] * p_vv)
+       + (U.T.dot(l[:,3*[0]] * p_u) +
+          V.T.dot(l[:,3*[1]] * p_v) +
+          (U.T.dot(l[:,3*[2]] * p_v) + V.T.dot(l[:,3*[2]] * p_u)) / 2)
        )
 
   ## The restriction functions, pretty straight forward.
@@ -80,12 +91,125 @@ def sys_eqs(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   
   return r_[ravel(h), ravel(g)]
 
-def sys_jacobian(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
+## Low-level scipy routine that accumulates the product of a CSR matrix by a
+## set of vectors into an existing array.
+try:
+  from scipy.sparse._sparsetools import csr_matvecs
+except ImportError:
+  csr_matvecs = None
+
+def csr_dot(A, x, out, accumulate=False):
+  '''Calculates A.dot(x) for a CSR matrix A and a contiguous 2D array x,
+  writing the result into out instead of allocating a new array. If accumulate
+  is True the product is added to the current contents of out.'''
+  if not accumulate:
+    out.fill(0)
+  if csr_matvecs is None:
+    out += A.dot(x)
+  else:
+    csr_matvecs(A.shape[0], A.shape[1], x.shape[1], A.indptr, A.indices,
+                A.data, x.ravel(), out.ravel())
+  return out
+
+class ResidualEvaluator:
+  '''Calculates the same function as sys_eqs, for a fixed set of operators.
+  The transposed operators and the regularization weights are calculated only
+  once, and every evaluation writes into preallocated arrays, so the solvers
+  can call it many times without creating any temporaries. The call has the
+  same arguments as sys_eqs so it can replace it, but the operators passed to
+  it are ignored.
+
+  The returned array is reused by the next call, and must be copied if it is
+  going to be kept.'''
+
+  def __init__(self, U, V, UU, VV):
+    self.N = U.shape[0]
+    self.U = scipy.sparse.csr_matrix(U)
+    self.V = scipy.sparse.csr_matrix(V)
+    self.UT = self.U.T.tocsr()
+    self.VT = self.V.T.tocsr()
+    self.UU = scipy.sparse.csr_matrix(UU)
+    self.VV = scipy.sparse.csr_matrix(VV)
+    self.wu = self.UU.diagonal()[:,newaxis]
+    self.wv = self.VV.diagonal()[:,newaxis]
+
+    ## Workspaces for the derivatives, and the output vector, with views to
+    ## its h and g parts.
+    self.p_u = zeros((self.N, 3))
+    self.p_v = zeros((self.N, 3))
+    self.p_uu = zeros((self.N, 3))
+    self.p_vv = zeros((self.N, 3))
+    self.tmp = zeros((self.N, 3))
+    self.out = zeros(6 * self.N)
+    self.h = self.out[:3*self.N].reshape(self.N, 3)
+    self.g = self.out[3*self.N:].reshape(self.N, 3)
+
+  def __call__(self, pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
+    N = self.N
+    p = pl[:3*N].reshape(N, 3)
+    l = pl[3*N:].reshape(N, 3)
+    p_u, p_v, tmp, h, g = self.p_u, self.p_v, self.tmp, self.h, self.g
+
+    csr_dot(self.U, p, p_u)
+    csr_dot(self.V, p, p_v)
+    csr_dot(self.UU, p, self.p_uu)
+    csr_dot(self.VV, p, self.p_vv)
+
+    ## h = p - q + Gamma * (wu * p_uu + wv * p_vv)
+    multiply(self.wu, self.p_uu, h)
+    multiply(self.wv, self.p_vv, tmp)
+    h += tmp
+    h *= Gamma
+    h += p
+    h -= q
+
+    ## Plus the multiplier terms, accumulated directly into h.
+    multiply(l[:,0:1], p_u, tmp)
+    csr_dot(self.UT, tmp, h, True)
+    multiply(l[:,1:2], p_v, tmp)
+    csr_dot(self.VT, tmp, h, True)
+    multiply(l[:,2:3], p_v, tmp)
+    tmp *= 0.5
+    csr_dot(self.UT, tmp, h, True)
+    multiply(l[:,2:3], p_u, tmp)
+    tmp *= 0.5
+    csr_dot(self.VT, tmp, h, True)
+
+    ## The restriction functions.
+    multiply(p_u, p_u, tmp)
+    tmp.sum(1, out=g[:,0])
+    multiply(p_v, p_v, tmp)
+    tmp.sum(1, out=g[:,1])
+    multiply(p_u, p_v, tmp)
+    tmp.sum(1, out=g[:,2])
+    g[:,:2] -= mesh_scale**2
+
+    return self.out
+
+def _row_pairs(A, B):
+  '''Pairs every non-zero value from each line of the CSR matrix A with every
+  non-zero value in the same line of B. Returns the positions of the pair
+  members in A.data and B.data, and the line where each pair was found. This
+  is what we need to build products such as dot(dot(A.T, diag(x)), B).'''
+  na = diff(A.indptr)
+  nb = diff(B.indptr)
+  npairs = na * nb
+  line = repeat(arange(A.shape[0]), npairs)
+  ## Position of each pair inside its line.
+  k = arange(line.shape[0]) - repeat(cumsum(npairs) - npairs, npairs)
+  return A.indptr[line] + k / nb[line], B.indptr[line] + k % nb[line], line
+
+def sys_jacobian_sparse(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   '''This function returns the Jacobian matrix of the target function to fit an
-  inextensible surface to given data. It receives q (associated measurements) as
-  a parameter because it is necessary in sys_eqs, but it is never used in the
-  Jacobian calculation. At least this is the case for this specific and simple
-  distance function used...
+  inextensible surface to given data, as a scipy.sparse CSR matrix. It
+  receives q (associated measurements) as a parameter because it is necessary
+  in sys_eqs, but it is never used in the Jacobian calculation. At least this
+  is the case for this specific and simple distance function used...
+
+  The matrix is a saddle-point system made of four blocks. The coordinates of
+  the non-zero values are calculated directly from the structure of the
+  derivative operators, so memory and time grow linearly with the number of
+  points.
   '''
 
   assert (pl.shape[0] % 6) == 0
@@ -93,7 +217,9 @@ def sys_jacobian(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   ## Number of points
   Np = pl.shape[0]/6
 
-  output = zeros((Np,Np))
+  U = scipy.sparse.csr_matrix(U)
+  V = scipy.sparse.csr_matrix(V)
+  Laplace = scipy.sparse.coo_matrix(Laplace)
 
   ## Split pl into the p matrix with 3D coordinates of each point, and the l
   ## matrix with the 3 multipliers for the conditions over each point.
@@ -105,145 +231,706 @@ def sys_jacobian(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
   l = reshape(pl[3*Np:], (Np, -1))
 
   ## Calculate the p derivatives (sum U_j^k p_k^w) into temporary arrays.
-  p_u = dot(U, p)
-  p_v = dot(V, p)
+  p_u = U.dot(p)
+  p_v = V.dot(p)
 
   ## Derivative of the objective function (plus Lagrange stuff) relative to
-  ## coordinates. It is zero for any different dimensions, and is the same for
-  ## every three coordinates. So we can calculate the matrix once and replicate.
-  dhdp_base = (identity(Np)
-               + Gamma * Laplace
-               + (dot(dot(U.T, diag(l[:,0])), U) +
-                  dot(dot(V.T, diag(l[:,1])), V) +
-                  (dot(dot(U.T, diag(l[:,2])),V) +
-                   dot(dot(V.T, diag(l[:,2])),U))/2)
-               )
-
-  dhdp = zeros((3*Np, 3*Np))
-  dhdp[0::3,0::3] = dhdp_base
-  dhdp[1::3,1::3] = dhdp_base
-  dhdp[2::3,2::3] = dhdp_base
-
-  ## Calculate derivatives of restriction functions relative to
-  ## coordinates. There is probably a smarter way to calculate all that. We need
-  ## to figure out the really optimal ordering of all the variables, etc.
-  dgdp = zeros((3*Np, 3*Np))
-  dgudpx = 2 * dot(diag(p_u[:,0]), U)
-  dgudpy = 2 * dot(diag(p_u[:,1]), U)
-  dgudpz = 2 * dot(diag(p_u[:,2]), U)
-  dgvdpx = 2 * dot(diag(p_v[:,0]), V)
-  dgvdpy = 2 * dot(diag(p_v[:,1]), V)
-  dgvdpz = 2 * dot(diag(p_v[:,2]), V)
-  dguvdpx = dot(diag(p_v[:,0]), U) + dot(diag(p_u[:,0]), V)
-  dguvdpy = dot(diag(p_v[:,1]), U) + dot(diag(p_u[:,1]), V)
-  dguvdpz = dot(diag(p_v[:,2]), U) + dot(diag(p_u[:,2]), V)
-  dgdp[0::3,0::3] = dgudpx
-  dgdp[0::3,1::3] = dgudpy
-  dgdp[0::3,2::3] = dgudpz
-  dgdp[1::3,0::3] = dgvdpx
-  dgdp[1::3,1::3] = dgvdpy
-  dgdp[1::3,2::3] = dgvdpz
-  dgdp[2::3,0::3] = dguvdpx
-  dgdp[2::3,1::3] = dguvdpy
-  dgdp[2::3,2::3] = dguvdpz
+  ## coordinates. This is identity(Np) + Gamma * Laplace + dot(dot(U.T,
+  ## diag(l[:,0])), U) + dot(dot(V.T, diag(l[:,1])), V) + (dot(dot(U.T,
+  ## diag(l[:,2])),V) + dot(dot(V.T, diag(l[:,2])),U))/2. Each product has one
+  ## value for each pair of non-zeros found in the same line of the operators.
+  base_row = [arange(Np), Laplace.row]
+  base_col = [arange(Np), Laplace.col]
+  base_val = [ones(Np), Gamma * Laplace.data]
+  for A, B, lw in [(U, U, l[:,0]), (V, V, l[:,1]),
+                   (U, V, l[:,2]/2), (V, U, l[:,2]/2)]:
+    ia, ib, line = _row_pairs(A, B)
+    base_row.append(A.indices[ia])
+    base_col.append(B.indices[ib])
+    base_val.append(A.data[ia] * lw[line] * B.data[ib])
+  base_row = concatenate(base_row)
+  base_col = concatenate(base_col)
+  base_val = concatenate(base_val)
+
+  ## It is zero for any different dimensions, and is the same for every three
+  ## coordinates. So we calculate the values once and replicate.
+  rows = [3*base_row + w for w in range(3)]
+  cols = [3*base_col + w for w in range(3)]
+  vals = 3 * [base_val]
+
+  ## Calculate derivatives of restriction functions relative to coordinates.
+  ## Restriction c of point i over coordinate w of point j goes into line
+  ## 3*i+c and column 3*j+w.
+  u_line = repeat(arange(Np), diff(U.indptr))
+  v_line = repeat(arange(Np), diff(V.indptr))
+  dg_row = []
+  dg_col = []
+  dg_val = []
+  for w in range(3):
+    dg_row += [3*u_line, 3*v_line+1, 3*u_line+2, 3*v_line+2]
+    dg_col += [3*U.indices+w, 3*V.indices+w, 3*U.indices+w, 3*V.indices+w]
+    dg_val += [2 * p_u[u_line,w] * U.data,
+               2 * p_v[v_line,w] * V.data,
+               p_v[u_line,w] * U.data,
+               p_u[v_line,w] * V.data]
+  dg_row = concatenate(dg_row)
+  dg_col = concatenate(dg_col)
+  dg_val = concatenate(dg_val)
+
+  ## The dgdp block goes below dhdp.
+  rows.append(3*Np + dg_row)
+  cols.append(dg_col)
+  vals.append(dg_val)
 
   ## Calculate derivatives of objective function gradient relative to Lagrange
   ## multipliers. It turns out it's just the transpose of the dgdp, scaled. That
   ## probably means something good.
-  dhdl = 0.5*dgdp.T
+  rows.append(dg_col)
+  cols.append(3*Np + dg_row)
+  vals.append(0.5 * dg_val)
 
   ## Derivatives of restriction functions relative to multipliers are just 0.
-  dgdl = zeros((3*Np, 3*Np))
-
-  ## Assemble result witht he four blocks
-  jacobian = zeros((6*Np, 6*Np))
-  jacobian[:3*Np,:3*Np] = dhdp
-  jacobian[:3*Np,3*Np:] = dhdl
-  jacobian[3*Np:,:3*Np] = dgdp
-  jacobian[3*Np:,3*Np:] = dgdl
-
-  return jacobian
-
-def calculate_U_and_V(Nl,Nk):
-  ## Initialize matrices with zeros.
-  U = zeros((Nl*Nk,Nl*Nk))
-  V = zeros((Nl*Nk,Nl*Nk))
-
-  eight_neighborhood = array([-1-Nk, -Nk, 1-Nk, -1, 0, 1, -1+Nk, Nk, 1+Nk], dtype=int16)
-  for l in range(Nl):
-    for k in range(Nk):
-      ## The point around which we are taking the derivative. Index calculated
-      ## using normal row-major order.
-      ind = l*Nk+k
-      ## The reference point ("Destination" index) around which we set the
-      ## values of the Sobel operator, or whatever filter is chosen to calculate
-      ## the derivatives. This is for the magic in the next lines
-      dind = ind
-
-      # if l>1 and l < Nl-1 and k>1 and k < Nk-1 : NOP
-      ## The derivatives in the borders are the same values as the derivatives
-      ## right inside the rectangle. So we just modify dind accordingly.
-      if k == 0:
-        dind += 1
-      elif k == Nk-1:
-        dind -= 1
-      if l == 0:
-        dind += Nk
-      elif l == Nl-1:
-        dind -= Nk
-
-      ## Shigeru filter 3x3 doi://10.1109/34.841757
-      U[ind, dind + eight_neighborhood] = array([-0.112737,0,0.112737,
-                                                  -0.274526,0,0.274526,
-                                                  -0.112737,0,0.112737])
-      V[ind, dind + eight_neighborhood] = array([-0.112737,-0.274526,-0.112737,
-                                                  0,0,0,
-                                                  0.112737,0.274526,0.112737])
-      ## Sobel filter
-      #U[ind, dind + eight_neighborhood] = array([-1,0,1,-2,0,2,-1,0,1])/8.
-      #V[ind, dind + eight_neighborhood] = array([-1,-2,-1,0,0,0,1,2,1])/8.
-      ## Scharr filter
-      #U[ind, dind + eight_neighborhood] = array([-3,0,3,-10,0,10,-3,0,3])/32.
-      #V[ind, dind + eight_neighborhood] = array([-3,-10,-3,0,0,0,3,10,3])/32.
-
-  return U, V
-
-def calculate_2nd_devs(Nl,Nk):
-  ## Initialize matrices with zeros.
-  UU = zeros((Nl*Nk,Nl*Nk))
-  VV = zeros((Nl*Nk,Nl*Nk))
-  Laplace = zeros((Nl*Nk,Nl*Nk))
-
-  u_neighborhood = array([-1, 0, 1], dtype=int16)
-  v_neighborhood = array([-Nk, 0, Nk], dtype=int16)
-  for l in range(Nl):
-    for k in range(Nk):
-      ## The point around which we are taking the derivative. Index calculated
-      ## using normal row-major order.
-      ind = l*Nk+k
-
-      if k > 0 and k < Nk - 1:
-        UU[ind, ind + u_neighborhood] = array([1,-2,1])
-      if l > 0 and l < Nl - 1:
-        VV[ind, ind + v_neighborhood] = array([1,-2,1])
-
-  for l in range(Nl*Nk):
-    for k in range(Nk*Nl):
-      Laplace[l,k] = UU[l,l] * UU[l,k] + VV[l,l] * VV[l,k]
+  ## Repeated coordinates are summed up during the conversion to CSR.
+  jacobian = scipy.sparse.coo_matrix(
+    (concatenate(vals), (concatenate(rows), concatenate(cols))),
+    shape=(6*Np, 6*Np))
+  return jacobian.tocsr()
+
+def sys_jacobian(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma):
+  '''Dense version of sys_jacobian_sparse, for solvers such as leastsq that
+  can only take a plain array.'''
+  return sys_jacobian_sparse(pl, q, U, V, UU, VV, Laplace,
+                             mesh_scale, Gamma).toarray()
+
+## Derivative filters over the 3x3 neighbourhood of each point, in row-major
+## order. The first item is the u (column) derivative, and the second one is
+## the v (line) derivative, which is just the transpose.
+_shigeru = array([[-0.112737, 0, 0.112737],
+                  [-0.274526, 0, 0.274526],
+                  [-0.112737, 0, 0.112737]])
+_sobel = array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]) / 8.
+_scharr = array([[-3, 0, 3], [-10, 0, 10], [-3, 0, 3]]) / 32.
+derivative_stencils = {
+  ## Shigeru filter 3x3 doi://10.1109/34.841757
+  'shigeru': (_shigeru.ravel(), _shigeru.T.ravel()),
+  'sobel': (_sobel.ravel(), _sobel.T.ravel()),
+  'scharr': (_scharr.ravel(), _scharr.T.ravel()),
+  }
+
+def sparse_leastsq(func, x0, args=(), Dfun=sys_jacobian_sparse, ftol=1.49012e-8,
+                   xtol=1.49012e-8, maxiter=200, deadline=None):
+  '''Levenberg-Marquardt least-squares fitting over a sparse jacobian. This is
+  a replacement for scipy.optimize.leastsq, which only works with dense
+  matrices. Each step solves the damped normal equations with a sparse LU
+  factorization, so the cost per iteration follows the number of non-zeros in
+  the jacobian and not the square of the number of parameters. If deadline is
+  given no new iteration is started after that time.time() value.
+
+  Returns the solution and a dictionary with the number of iterations,
+  function and jacobian evaluations and the final sum of squares.'''
+  x = array(x0, dtype=float)
+  r = array(func(x, *args))
+  cost = dot(r, r)
+  nfev, njev = 1, 0
+  ## Damping factor, and its growth rate when steps are rejected.
+  mu = 1e-3
+  nu = 2.0
+
+  nit = 0
+  while nit < maxiter:
+    if deadline is not None and time.time() > deadline:
+      break
+    J = Dfun(x, *args)
+    njev += 1
+    nit += 1
+    JtJ = (J.T * J).tocsc()
+    grad = J.T.dot(r)
+    ## Marquardt scaling, damping each parameter by its own curvature. The
+    ## floor avoids a singular system for parameters that have no effect.
+    scale = maximum(JtJ.diagonal(), 1e-12 * JtJ.diagonal().max())
+
+    ## Increase the damping until the step reduces the residue.
+    while True:
+      A = (JtJ + mu * scipy.sparse.diags(scale)).tocsc()
+      dx = scipy.sparse.linalg.splu(A).solve(-grad)
+      x_new = x + dx
+      r_new = func(x_new, *args)
+      nfev += 1
+      cost_new = dot(r_new, r_new)
+      ## Gain ratio between the actual and predicted reductions.
+      predicted = -dot(dx, grad) + mu * dot(dx * scale, dx)
+      rho = (cost - cost_new) / predicted if predicted > 0 else -1
+      if rho > 0:
+        mu *= max(1/3., 1 - (2 * rho - 1) ** 3)
+        nu = 2.0
+        break
+      mu *= nu
+      nu *= 2
+      if mu > 1e16:
+        break
+
+    if rho <= 0:
+      break
+
+    step_small = norm(dx) <= xtol * (norm(x) + xtol)
+    reduction_small = cost - cost_new <= ftol * cost
+    x, r, cost = x_new, r_new.copy(), cost_new
+    if step_small or reduction_small:
+      break
+
+  return x, {'nit': nit, 'nfev': nfev, 'njev': njev, 'cost': cost}
+
+class DeadlineExceeded(Exception):
+  pass
+
+def deadline_leastsq(func, x0, args=(), Dfun=sys_jacobian, deadline=None):
+  '''scipy.optimize.leastsq with a time limit. MINPACK cannot be stopped from
+  outside, so the function and jacobian raise DeadlineExceeded once the
+  time.time() value deadline has passed, and the evaluated point with the
+  smallest sum of squares is returned. Returns the solution and the info
+  dictionary from leastsq, or one with just 'nfev' if the time ran out, with
+  'timeout' added to it.'''
+  best = {'x': array(x0, dtype=float), 'cost': inf, 'nfev': 0}
+
+  def timed_func(x, *args):
+    if deadline is not None and time.time() > deadline:
+      raise DeadlineExceeded()
+    r = func(x, *args)
+    best['nfev'] += 1
+    cost = dot(r, r)
+    if cost < best['cost']:
+      best.update(x=x.copy(), cost=cost)
+    return r
+
+  def timed_Dfun(x, *args):
+    if deadline is not None and time.time() > deadline:
+      raise DeadlineExceeded()
+    return Dfun(x, *args)
+
+  try:
+    x, cov, info, msg, ier = scipy.optimize.leastsq(
+      timed_func, x0, args=args, Dfun=timed_Dfun, full_output=1)
+    info['timeout'] = False
+  except DeadlineExceeded:
+    x = best['x']
+    info = {'nfev': best['nfev'], 'timeout': True}
+  return x, info
+
+def kkt_newton(func, x0, args=(), Dfun=sys_jacobian_sparse, ftol=1e-20,
+               maxiter=100, reg=1e-8, refine=2, deadline=None):
+  '''Newton iterations over the square system of stationarity and restriction
+  equations (the Karush-Kuhn-Tucker conditions) from sys_eqs. Each step solves
+  dot(J, dx) = -r with a sparse LU factorization of the saddle-point jacobian.
+
+  The jacobian is singular, because the derivative operators have a null
+  space, so the factorized matrix has a small regularization reg added to the
+  coordinates block and subtracted from the multipliers block. A few rounds of
+  iterative refinement against the original jacobian remove most of the bias.
+
+  The step length is chosen by backtracking over the sum of squares of the
+  residue. When no step length gives a sufficient decrease we fall back to a
+  few iterations of sparse_leastsq, that always makes progress. If deadline
+  is given no new iteration is started after that time.time() value.
+
+  Returns the solution and a dictionary with the number of iterations,
+  factorizations, function evaluations, the final sum of squares and whether
+  it reached ftol, 'converged'. The system only has an exact solution when
+  the mesh can fit the input points, so it does not converge in other cases,
+  e.g. when the mesh is larger than the surface.'''
+  x = array(x0, dtype=float)
+  Nh = x.shape[0]/2
+  r = array(func(x, *args))
+  cost = dot(r, r)
+  nfev, nfact, nit = 1, 0, 0
+
+  while nit < maxiter and cost > ftol:
+    if deadline is not None and time.time() > deadline:
+      break
+    J = Dfun(x, *args)
+    K = J + scipy.sparse.diags(r_[reg * ones(Nh), -reg * ones(Nh)])
+    lu = scipy.sparse.linalg.splu(K.tocsc())
+    nfact += 1
+    dx = lu.solve(-r)
+    for k in range(refine):
+      dx += lu.solve(-r - J.dot(dx))
+
+    ## Backtracking line search, with the Armijo sufficient decrease condition
+    ## for the merit function r**2, whose slope along dx is -2 * cost.
+    t = 1.0
+    while t > 1e-3:
+      x_new = x + t * dx
+      r_new = func(x_new, *args)
+      nfev += 1
+      cost_new = dot(r_new, r_new)
+      if cost_new <= (1 - 1e-4 * t) * cost:
+        break
+      t /= 2
+    else:
+      x_new, info = sparse_leastsq(func, x, args, Dfun, maxiter=5,
+                                   deadline=deadline)
+      nfev += info['nfev']
+      nfact += info['njev']
+      r_new = func(x_new, *args)
+      nfev += 1
+      cost_new = dot(r_new, r_new)
+      if cost_new >= cost:
+        break
+
+    x, r, cost = x_new, r_new.copy(), cost_new
+    nit += 1
+
+  return x, {'nit': nit, 'nfact': nfact, 'nfev': nfev, 'cost': cost,
+             'converged': bool(cost <= ftol)}
+
+def _batch_dot(A, X):
+  '''Applies the operator A to every model of the (B, Np, 3) array X with a
+  single sparse product, laying the models side by side as columns.'''
+  B, Np = X.shape[:2]
+  Y = A.dot(X.transpose(1, 0, 2).reshape(Np, -1))
+  return Y.reshape(-1, B, 3).transpose(1, 0, 2)
+
+def batch_sys_eqs(PL, Q, U, V, UU, VV, mesh_scale, Gamma):
+  '''Calculates sys_eqs for B models of the same size at once. PL is a (B,
+  6*Np) array with the parameters of each model, and Q a (B, Np, 3) array
+  with their input points. mesh_scale and Gamma can be scalars or have one
+  value per model. Returns a (B, 6*Np) array whose lines are the sys_eqs
+  output of each model.'''
+  B = PL.shape[0]
+  Np = PL.shape[1]/6
+  P = PL[:,:3*Np].reshape(B, Np, 3)
+  L = PL[:,3*Np:].reshape(B, Np, 3)
+  mesh_scale = asarray(mesh_scale, dtype=float).reshape(-1, 1)
+  Gamma = asarray(Gamma, dtype=float).reshape(-1, 1, 1)
+
+  P_u = _batch_dot(U, P)
+  P_v = _batch_dot(V, P)
+  P_uu = _batch_dot(UU, P)
+  P_vv = _batch_dot(VV, P)
+
+  H = (P - Q
+       + Gamma * (UU.diagonal()[:,newaxis] * P_uu +
+                  VV.diagonal()[:,newaxis] * P_vv)
+       + _batch_dot(U.T, L[:,:,[0]] * P_u + L[:,:,[2]] * P_v / 2)
+       + _batch_dot(V.T, L[:,:,[1]] * P_v + L[:,:,[2]] * P_u / 2))
+
+  G = zeros((B, Np, 3))
+  G[:,:,0] = einsum('bnw,bnw->bn', P_u, P_u) - mesh_scale**2
+  G[:,:,1] = einsum('bnw,bnw->bn', P_v, P_v) - mesh_scale**2
+  G[:,:,2] = einsum('bnw,bnw->bn', P_u, P_v)
+
+  return c_[H.reshape(B, -1), G.reshape(B, -1)]
+
+def _batch_jacobian_values(PL, U, V, Laplace, Gamma):
+  '''Calculates the jacobians from sys_jacobian_sparse of B models of the same
+  size. The positions of the non-zero values are the same for every model, so
+  they are calculated only once. Returns the rows and columns of the values,
+  and a (B, nnz) array with the values of each model. Repeated positions must
+  be summed up.'''
+  B = PL.shape[0]
+  Np = PL.shape[1]/6
+  U = scipy.sparse.csr_matrix(U)
+  V = scipy.sparse.csr_matrix(V)
+  Laplace = scipy.sparse.coo_matrix(Laplace)
+  Gamma = asarray(Gamma, dtype=float).reshape(-1, 1) * ones((B, 1))
+
+  P = PL[:,:3*Np].reshape(B, Np, 3)
+  L = PL[:,3*Np:].reshape(B, Np, 3)
+  P_u = _batch_dot(U, P)
+  P_v = _batch_dot(V, P)
+
+  ## The dhdp block, see sys_jacobian_sparse.
+  base_row = [arange(Np), Laplace.row]
+  base_col = [arange(Np), Laplace.col]
+  base_val = [ones((B, Np)), Gamma * Laplace.data]
+  for A, C, lw in [(U, U, L[:,:,0]), (V, V, L[:,:,1]),
+                   (U, V, L[:,:,2]/2), (V, U, L[:,:,2]/2)]:
+    ia, ic, line = _row_pairs(A, C)
+    base_row.append(A.indices[ia])
+    base_col.append(C.indices[ic])
+    base_val.append(A.data[ia] * lw[:,line] * C.data[ic])
+  base_row = concatenate(base_row)
+  base_col = concatenate(base_col)
+  base_val = concatenate(base_val, 1)
+
+  rows = [3*base_row + w for w in range(3)]
+  cols = [3*base_col + w for w in range(3)]
+  vals = 3 * [base_val]
+
+  ## The dgdp block, and its scaled transpose.
+  u_line = repeat(arange(Np), diff(U.indptr))
+  v_line = repeat(arange(Np), diff(V.indptr))
+  dg_row = []
+  dg_col = []
+  dg_val = []
+  for w in range(3):
+    dg_row += [3*u_line, 3*v_line+1, 3*u_line+2, 3*v_line+2]
+    dg_col += [3*U.indices+w, 3*V.indices+w, 3*U.indices+w, 3*V.indices+w]
+    dg_val += [2 * P_u[:,u_line,w] * U.data,
+               2 * P_v[:,v_line,w] * V.data,
+               P_v[:,u_line,w] * U.data,
+               P_u[:,v_line,w] * V.data]
+  dg_row = concatenate(dg_row)
+  dg_col = concatenate(dg_col)
+  dg_val = concatenate(dg_val, 1)
+
+  rows += [3*Np + dg_row, dg_col]
+  cols += [dg_col, 3*Np + dg_row]
+  vals += [dg_val, 0.5 * dg_val]
+
+  return concatenate(rows), concatenate(cols), concatenate(vals, 1)
+
+def batch_jacobian_sparse(PL, U, V, Laplace, Gamma):
+  '''Returns the jacobians of B models of the same size as the blocks of a
+  block-diagonal CSR matrix.'''
+  B, N = PL.shape
+  rows, cols, vals = _batch_jacobian_values(PL, U, V, Laplace, Gamma)
+  offset = N * arange(B)[:,newaxis]
+  jacobian = scipy.sparse.coo_matrix(
+    (vals.ravel(), ((rows + offset).ravel(), (cols + offset).ravel())),
+    shape=(N*B, N*B))
+  return jacobian.tocsr()
+
+def batch_kkt_newton(PL0, Q, U, V, UU, VV, Laplace, mesh_scale, Gamma,
+                     ftol=1e-20, maxiter=100, reg=1e-8, refine=2):
+  '''Runs kkt_newton over B models of the same size at once. Each iteration
+  evaluates the residues of all models with batch_sys_eqs, and factorizes
+  their block-diagonal jacobian from batch_jacobian_sparse together. Models
+  leave the batch as soon as they converge, or when their line search fails,
+  and those go through the kkt_newton fallback alone.
+
+  Returns the (B, 6*Np) array of solutions, and a list with a dictionary for
+  each model, like the one from kkt_newton.'''
+  X = array(PL0, dtype=float)
+  B, N = X.shape
+  mesh_scale = asarray(mesh_scale, dtype=float) * ones(B)
+  Gamma = asarray(Gamma, dtype=float) * ones(B)
+
+  R = batch_sys_eqs(X, Q, U, V, UU, VV, mesh_scale, Gamma)
+  cost = (R**2).sum(1)
+  nit = zeros(B, dtype=int)
+  nfev = ones(B, dtype=int)
+  nfact = 0
+  regs = r_[reg * ones(N/2), -reg * ones(N/2)]
+
+  active = nonzero(cost > ftol)[0]
+  while active.shape[0] > 0:
+    Na = active.shape[0]
+    J = batch_jacobian_sparse(X[active], U, V, Laplace, Gamma[active])
+    K = J + scipy.sparse.diags(tile(regs, Na))
+    lu = scipy.sparse.linalg.splu(K.tocsc())
+    nfact += 1
+    r = ravel(R[active])
+    dx = lu.solve(-r)
+    for k in range(refine):
+      dx += lu.solve(-r - J.dot(dx))
+    dx = dx.reshape(Na, N)
+
+    ## Backtracking line search of each model, like in kkt_newton. Only the
+    ## models that did not find their step yet are evaluated again.
+    t = ones(Na)
+    X_new = X[active] + dx
+    R_new = R[active].copy()
+    cost_new = cost[active].copy()
+    searching = arange(Na)
+    while searching.shape[0] > 0:
+      X_new[searching] = (X[active[searching]] +
+                          t[searching,newaxis] * dx[searching])
+      R_new[searching] = batch_sys_eqs(
+        X_new[searching], Q[active[searching]], U, V, UU, VV,
+        mesh_scale[active[searching]], Gamma[active[searching]])
+      nfev[active[searching]] += 1
+      cost_new[searching] = (R_new[searching]**2).sum(1)
+      ok = (cost_new[searching] <=
+            (1 - 1e-4 * t[searching]) * cost[active[searching]])
+      t[searching[~ok]] /= 2
+      searching = searching[~ok & (t[searching] > 1e-3)]
+
+    ## Models whose line search failed are finished by kkt_newton alone.
+    failed = t <= 1e-3
+    for i in nonzero(failed)[0]:
+      m = active[i]
+      args = (Q[m], U, V, UU, VV, Laplace, mesh_scale[m], Gamma[m])
+      X_new[i], info = kkt_newton(sys_eqs, X[m], args,
+                                  ftol=ftol, maxiter=maxiter - nit[m],
+                                  reg=reg, refine=refine)
+      R_new[i] = sys_eqs(X_new[i], *args)
+      cost_new[i] = info['cost']
+      nit[m] += info['nit']
+      nfev[m] += info['nfev']
+      nfact += info['nfact']
+
+    X[active] = X_new
+    R[active] = R_new
+    cost[active] = cost_new
+    nit[active[~failed]] += 1
+    active = active[~failed & (cost_new > ftol) & (nit[active] < maxiter)]
+
+  return X, [{'nit': nit[m], 'nfev': nfev[m], 'nfact': nfact,
+              'cost': cost[m], 'converged': bool(cost[m] <= ftol)}
+             for m in range(B)]
+
+def calculate_U_and_V(Nl, Nk, stencil='shigeru'):
+  '''Builds the U and V operators that calculate the partial derivatives over
+  the u and v directions of a Nl x Nk mesh, as scipy.sparse CSR matrices. Each
+  line has at most 9 non-zero values, taken from the chosen derivative filter
+  in derivative_stencils.'''
+  u_filter, v_filter = derivative_stencils[stencil]
+
+  ## The point around which we are taking the derivative. Index calculated
+  ## using normal row-major order.
+  l, k = mgrid[:Nl,:Nk].reshape(2,-1)
+  ind = l*Nk+k
+
+  ## The reference point ("Destination" index) around which we set the values
+  ## of the filter. The derivatives in the borders are the same values as the
+  ## derivatives right inside the rectangle. So we just move dind inwards.
+  dind = (ind + (k == 0) - (k == Nk-1)
+          + Nk * ((l == 0).astype(int) - (l == Nl-1)))
+
+  eight_neighborhood = array([-1-Nk, -Nk, 1-Nk, -1, 0, 1, -1+Nk, Nk, 1+Nk])
+  rows = repeat(ind, 9)
+  cols = (dind[:,newaxis] + eight_neighborhood).ravel()
+
+  def operator(weights):
+    data = tile(weights, Nl*Nk)
+    nz = data != 0
+    return scipy.sparse.csr_matrix((data[nz], (rows[nz], cols[nz])),
+                                   shape=(Nl*Nk, Nl*Nk))
+
+  return operator(u_filter), operator(v_filter)
+
+def calculate_2nd_devs(Nl, Nk):
+  '''Builds the UU and VV second derivative operators of a Nl x Nk mesh, and
+  the Laplace matrix used in the regularization term of the jacobian. All of
+  them are returned as scipy.sparse CSR matrices. The second derivatives are
+  zero over the borders.'''
+  ## The point around which we are taking the derivative. Index calculated
+  ## using normal row-major order.
+  l, k = mgrid[:Nl,:Nk].reshape(2,-1)
+  ind = l*Nk+k
+
+  second_derivative = array([1., -2., 1.])
+
+  def operator(inside, step):
+    rows = repeat(ind[inside], 3)
+    cols = (ind[inside][:,newaxis] + step * array([-1, 0, 1])).ravel()
+    data = tile(second_derivative, inside.sum())
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(Nl*Nk, Nl*Nk))
+
+  UU = operator((k > 0) & (k < Nk - 1), 1)
+  VV = operator((l > 0) & (l < Nl - 1), Nk)
+
+  ## Laplace[l,k] = UU[l,l] * UU[l,k] + VV[l,l] * VV[l,k], i.e. the lines of
+  ## each operator scaled by its own diagonal.
+  Laplace = (scipy.sparse.diags(UU.diagonal()) * UU +
+             scipy.sparse.diags(VV.diagonal()) * VV).tocsr()
 
   return UU, VV, Laplace
 
 
 
+def restrict_solution(pl, Nl, Nk, step):
+  '''Takes a solution vector from a Nl x Nk mesh, and returns the solution
+  over the coarser mesh made of every step-th line and column.'''
+  return ravel(pl.reshape(2, Nl, Nk, 3)[:,::step,::step])
+
+def prolong_solution(pl, Nl, Nk, Nl_new, Nk_new):
+  '''Bilinear interpolation of a solution vector from a Nl x Nk mesh into a
+  Nl_new x Nk_new mesh covering the same region, i.e. with a mesh_scale
+  smaller by (Nl_new-1)/(Nl-1). The multipliers are interpolated just like
+  the coordinates. They are only a rough initial guess, because they have
+  components over the null space of the derivative operators, and
+  estimate_multipliers gives a better one.'''
+  ## Coordinates of the new points over the old mesh, in index units.
+  scale = array([(Nl - 1.) / (Nl_new - 1), (Nk - 1.) / (Nk_new - 1)])
+  ll, kk = mgrid[:Nl_new,:Nk_new] * scale[:,newaxis,newaxis]
+  grid = pl.reshape(2, Nl, Nk, 3)
+  out = zeros((2, Nl_new, Nk_new, 3))
+  for i in range(2):
+    for w in range(3):
+      out[i,:,:,w] = scipy.ndimage.map_coordinates(grid[i,:,:,w], [ll, kk],
+                                                   order=1)
+  return ravel(out)
+
+def estimate_multipliers(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma,
+                         reg=1e-8):
+  '''Replaces the multipliers in pl by the ones that best satisfy the
+  stationarity equations from sys_eqs for its coordinates. Those equations
+  are linear over the multipliers, so this is a linear least-squares problem
+  over the multipliers block of the jacobian, solved with a sparse LU
+  factorization of its normal equations, regularized by reg. It is cheaper
+  than a Newton step, and gives a starting point for kkt_newton that is
+  closer to the solution than interpolated or zero multipliers when the
+  coordinates are already good.'''
+  N = pl.shape[0]/6
+  pl = array(pl, dtype=float)
+  pl[3*N:] = 0
+  h = sys_eqs(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma)[:3*N]
+  J = sys_jacobian_sparse(pl, q, U, V, UU, VV, Laplace, mesh_scale, Gamma)
+  A = J.tocsc()[:3*N,3*N:]
+  M = A.T * A + reg * scipy.sparse.identity(3*N)
+  pl[3*N:] = scipy.sparse.linalg.splu(M.tocsc()).solve(-A.T.dot(h))
+  return pl
+
+class OperatorCache:
+  '''Stores the U, V, UU, VV and Laplace operators of each mesh geometry, since
+  they depend only on (Nl, Nk) and the stencil. The most recently used
+  geometries are kept in memory, and if cache_dir is given the operators are
+  also stored there as compressed .npz files, so that new processes can load
+  them instead of building them again. The matrices are shared between models,
+  and must not be modified. The cache can be used from many threads.'''
+
+  names = ['U', 'V', 'UU', 'VV', 'Laplace']
+
+  def __init__(self, maxsize=16, cache_dir=None):
+    self.maxsize = maxsize
+    self.cache_dir = cache_dir
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    ## Held over each whole lookup, so that concurrent threads never see a
+    ## popped entry, and a missing geometry is only built once.
+    self.lock = threading.Lock()
+
+  def get(self, Nl, Nk, stencil='shigeru'):
+    '''Returns the tuple (U, V, UU, VV, Laplace) for the given mesh.'''
+    key = (Nl, Nk, stencil)
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        ops = self.entries.pop(key)
+      else:
+        ops = self.load(key)
+        if ops is not None:
+          self.disk_hits += 1
+        else:
+          self.misses += 1
+          ops = (calculate_U_and_V(Nl, Nk, stencil) +
+                 calculate_2nd_devs(Nl, Nk))
+          self.save(key, ops)
+      ## Re-insert at the end, the least recently used entries are at the
+      ## start.
+      self.entries[key] = ops
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+    return ops
+
+  def filename(self, key):
+    return os.path.join(self.cache_dir, 'operators_%dx%d_%s.npz' % key)
+
+  def load(self, key):
+    if self.cache_dir is None or not os.path.exists(self.filename(key)):
+      return None
+    data = load(self.filename(key))
+    return tuple(scipy.sparse.csr_matrix((data[name + '_data'],
+                                          data[name + '_indices'],
+                                          data[name + '_indptr']),
+                                         shape=data[name + '_shape'])
+                 for name in self.names)
+
+  def save(self, key, ops):
+    if self.cache_dir is None:
+      return
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    arrays = {}
+    for name, M in zip(self.names, ops):
+      arrays[name + '_data'] = M.data
+      arrays[name + '_indices'] = M.indices
+      arrays[name + '_indptr'] = M.indptr
+      arrays[name + '_shape'] = array(M.shape)
+    ## Write into a temporary file first, so parallel workers never read a
+    ## partially written cache.
+    tmpname = self.filename(key)[:-4] + '.%d.tmp.npz' % os.getpid()
+    savez_compressed(tmpname, **arrays)
+    os.rename(tmpname, self.filename(key))
+
+  def stats(self):
+    return {'hits': self.hits, 'disk_hits': self.disk_hits,
+            'misses': self.misses, 'size': len(self.entries)}
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = self.disk_hits = self.misses = 0
+
+## Cache used by default by all SurfaceModel objects.
+operator_cache = OperatorCache()
+
+class ProjectionSearch:
+  '''Correspondence search over an organized point cloud, such as the one
+  calculated from a disparity image. Instead of searching a kd-tree, each query
+  point is projected into the image with the pinhole model (focal distance f
+  and optical center in pixels), and the closest pixel is looked up directly.
+  If window is larger than 0, the closest point within the (2*window+1)**2
+  neighbouring pixels is taken. The query method has the same interface as the
+  one from KDTree, so this can be used in its place.
+
+  If the image has pixels without a valid reading, q_data may hold only the
+  valid ones, and pixel_index the pixel of each point, in line order. Query
+  points without any valid pixel in their window get the index -1 and an
+  infinite distance.'''
+
+  def __init__(self, q_data, shape, f, center, window=1, pixel_index=None):
+    self.q_data = q_data
+    self.shape = shape
+    self.f = f
+    self.center = array(center, dtype=float)
+    self.window = window
+    ## Pixel offsets of the search window, as (line, column) pairs.
+    self.offsets = mgrid[-window:window+1,-window:window+1].reshape(2,-1).T
+    ## Point of each pixel, -1 for the invalid ones.
+    if pixel_index is None:
+      self.point_index = None
+    else:
+      self.point_index = -ones(shape[0] * shape[1], dtype=int)
+      self.point_index[pixel_index] = arange(len(pixel_index))
+
+  def query(self, x, workers=1):
+    ## Project the points into the image, taking pixel coordinates as (column,
+    ## line) like in IntrinsicParameters.
+    z = maximum(x[:,2], 1e-12)
+    kl = self.center + self.f * x[:,:2] / z[:,newaxis]
+    k = around(kl[:,0]).astype(int)
+    l = around(kl[:,1]).astype(int)
+
+    ## Candidate pixels from the search window around each projection.
+    ll = clip(l[:,newaxis] + self.offsets[:,0], 0, self.shape[0] - 1)
+    kk = clip(k[:,newaxis] + self.offsets[:,1], 0, self.shape[1] - 1)
+    ind = ll * self.shape[1] + kk
+    if self.point_index is not None:
+      ind = self.point_index[ind]
+    dist = ((self.q_data[ind] - x[:,newaxis,:]) ** 2).sum(2)
+    if self.point_index is not None:
+      dist[ind < 0] = inf
+    best = argmin(dist, 1)
+    rows = arange(x.shape[0])
+    dist, ind = sqrt(dist[rows, best]), ind[rows, best]
+    ind[isinf(dist)] = -1
+    return dist, ind
+
 class SurfaceModel:
-  def __init__(self, Nl, Nk):
+  def __init__(self, Nl, Nk, stencil='shigeru', cache=None):
     self.Nl = Nl
     self.Nk = Nk
     self.Np = self.Nl * self.Nk
+    self.stencil = stencil
+
+    ## The U and V matrices (Partial derivatives on u and v directions), second
+    ## derivatives and Laplace matrix for regularization. These are sparse, and
+    ## shared with other models of the same size through the operator cache.
+    if cache is None:
+      cache = operator_cache
+    self.U, self.V, self.UU, self.VV, self.Laplace = cache.get(Nl, Nk, stencil)
 
-    ## Calculates the U and V matrices. (Partial derivatives on u and v directions).
-    self.U, self.V = calculate_U_and_V(self.Nl, self.Nk)
-    self.UU, self.VV, self.Laplace = calculate_2nd_devs(self.Nl,self.Nk)
+    ## Number of parallel workers for the kd-tree queries, -1 uses all CPUs.
+    self.workers = 1
+    ## Correspondences from the last assign_input_points call.
+    self.q_index = None
+
+    ## Evaluates sys_eqs for this model with preallocated buffers.
+    self.residuals = ResidualEvaluator(self.U, self.V, self.UU, self.VV)
 
   def calculate_initial_guess(self, mesh_scale, middle):
     ## Initial guess, Points over the xy plane
@@ -266,27 +953,314 @@ class SurfaceModel:
   def set_initial_guess(self, pl):
     self.pl0 = pl
 
-  def initialize_kdtree(self, q_data):
+  def initialize_kdtree(self, q_data, workers=-1, valid=None):
+    ## Only the points where valid is True are searched, if it is given.
+    if valid is not None:
+      q_data = q_data[ravel(valid)]
     self.q_data = q_data
-    self.xyz_tree = KDTree(self.q_data)
-
-  def assign_input_points(self):
-    q_query = self.xyz_tree.query(self.coordinates())
-    self.q = self.q_data[q_query[1]]
+    self.xyz_tree = cKDTree(self.q_data)
+    self.workers = workers
+    self.q_index = None
+
+  def initialize_projection(self, q_data, shape, intparam, window=1,
+                            pixel_index=None):
+    '''Uses a ProjectionSearch instead of a kd-tree to find correspondences.
+    q_data must be the organized point cloud from an image of the given shape,
+    one point per pixel in line order, or just the points of the pixels in
+    pixel_index. intparam holds the f and center of the camera, in the same
+    reference frame as the points.'''
+    self.q_data = q_data
+    self.xyz_tree = ProjectionSearch(q_data, shape, intparam.f,
+                                     intparam.center, window, pixel_index)
+    self.q_index = None
+
+  def query_input_points(self, x):
+    ## Newer scipy versions call n_jobs "workers".
+    try:
+      return self.xyz_tree.query(x, workers=self.workers)[1]
+    except TypeError:
+      return self.xyz_tree.query(x, n_jobs=self.workers)[1]
+
+  def assign_input_points(self, tol=0.0):
+    '''Finds the closest input point to each model point. Only the model points
+    that moved more than tol since the last call are searched again. Returns
+    the number of correspondences that changed, which is also kept at
+    n_changed. Points without a correspondence get the index -1.'''
+    p = self.coordinates()
+    if self.q_index is None:
+      new_index = self.query_input_points(p)
+      q_points = p.copy()
+      self.n_changed = self.Np
+    else:
+      moved = nonzero(sqrt(((p - self.q_points) ** 2).sum(1)) > tol)[0]
+      new_index = self.q_index.copy()
+      new_index[moved] = self.query_input_points(p[moved])
+      self.n_changed = (new_index != self.q_index).sum()
+      ## Points that did not move keep the position from when they were last
+      ## queried, so that slow drifts are eventually detected.
+      q_points = self.q_points.copy()
+      q_points[moved] = p[moved]
+    self.q_points = q_points
+    self.q_index = new_index
+    self.q = self.q_data[self.q_index]
+    ## Model points without any valid input point nearby are their own
+    ## correspondence, so only the regularization acts over them.
+    missing = self.q_index < 0
+    self.q[missing] = p[missing]
+    return self.n_changed
+
+  def fit(self, mesh_scale, Gamma, method='leastsq', deadline=None):
+    '''Solves the system from sys_eqs starting from pl0. The 'leastsq' method
+    uses MINPACK with the dense jacobian, 'sparse' runs the sparse_leastsq
+    Levenberg-Marquardt solver over the sparse jacobian, and 'newton' solves
+    the KKT system directly with kkt_newton. If kkt_newton stops before
+    converging a RuntimeWarning is issued. If deadline is given the solver
+    stops at that time.time() value, keeping the best solution so far.
+
+    Returns a dictionary from the solver, containing at least the number of
+    function evaluations, 'nfev'.'''
+    args = (self.q, self.U, self.V, self.UU, self.VV, self.Laplace,
+            mesh_scale, Gamma)
 
-  def fit(self, mesh_scale, Gamma):
     ## Run optimization
-    pl_opt, success = scipy.optimize.leastsq(sys_eqs, self.pl0,
-                                             args=(self.q, self.U, self.V,
-                                                   self.UU, self.VV,
-                                                   self.Laplace, mesh_scale, Gamma),
-                                             Dfun=sys_jacobian)
+    if method == 'leastsq' and deadline is None:
+      pl_opt, cov, info, msg, ier = scipy.optimize.leastsq(
+        self.residuals, self.pl0, args=args, Dfun=sys_jacobian, full_output=1)
+    elif method == 'leastsq':
+      pl_opt, info = deadline_leastsq(self.residuals, self.pl0, args=args,
+                                      Dfun=sys_jacobian, deadline=deadline)
+    elif method == 'sparse':
+      pl_opt, info = sparse_leastsq(self.residuals, self.pl0, args=args,
+                                    Dfun=sys_jacobian_sparse,
+                                    deadline=deadline)
+    elif method == 'newton':
+      pl_opt, info = kkt_newton(self.residuals, self.pl0, args=args,
+                                Dfun=sys_jacobian_sparse, deadline=deadline)
+      if not info['converged'] and (deadline is None or
+                                    time.time() <= deadline):
+        warnings.warn('kkt_newton did not converge after %d iterations, '
+                      'final cost %g' % (info['nit'], info['cost']),
+                      RuntimeWarning)
+    else:
+      raise ValueError('Unknown fitting method: %s' % method)
     self.pl0 = pl_opt
+    return info
+
+  def fit_icp(self, mesh_scale, Gamma, method='leastsq', max_rounds=10,
+              rtol=1e-2, atol=0.0, xtol=1e-3, min_changed=0, assign_tol=0.0,
+              max_time=None):
+    '''Alternates between assigning correspondences and fitting, like ICP,
+    until one of the stop conditions is met: the rms distance from the model
+    points to their input points decreased by less than rtol times its
+    previous value, or is below atol, the largest point displacement in the
+    last fit is below xtol*mesh_scale, no more than min_changed
+    correspondences changed, max_rounds fits were made, or max_time seconds
+    have passed. The time limit is also passed to the solver, so a fit is
+    interrupted when it runs out. Points without a correspondence are left
+    out of the residual. Returns a dictionary with the number of rounds, the
+    final rms residual, the elapsed time and the reason to stop.'''
+    t0 = time.time()
+    deadline = t0 + max_time if max_time is not None else None
+    reason = 'max_rounds'
+    residual = None
+    rounds = 0
+    while rounds < max_rounds:
+      changed = self.assign_input_points(assign_tol)
+      if rounds > 0 and changed <= min_changed:
+        reason = 'correspondences'
+        break
+
+      p_old = self.coordinates().copy()
+      self.fit(mesh_scale, Gamma, method, deadline=deadline)
+      rounds += 1
+
+      p = self.coordinates()
+      valid = self.q_index >= 0
+      residual_old = residual
+      residual = sqrt(((p[valid] - self.q[valid]) ** 2).sum(1).mean()
+                      if valid.any() else 0.0)
+      if deadline is not None and time.time() > deadline:
+        reason = 'max_time'
+        break
+      if residual <= atol or (residual_old is not None and
+                              residual_old - residual <= rtol * residual_old):
+        reason = 'residual'
+        break
+      if abs(p - p_old).max() < xtol * mesh_scale:
+        reason = 'xtol'
+        break
+
+    return {'rounds': rounds, 'residual': residual,
+            'time': time.time() - t0, 'reason': reason}
+
+  def fit_pyramid(self, mesh_scale, Gamma, levels=3, method='newton',
+                  min_size=3):
+    '''Coarse-to-fine fitting. The current pl0 is restricted into a coarser
+    mesh with every 2**(levels-1)-th line and column, which is fitted first.
+    The solution is then interpolated into a mesh twice as fine, refitted, and
+    so on until this model is reached, so most of the nonlinear work happens
+    over the cheap coarse levels. The multipliers of each level are calculated
+    with estimate_multipliers after its correspondences are assigned, since
+    interpolated multipliers are a poor guess. Coarse levels are dropped if the mesh size
+    does not divide evenly or gets smaller than min_size, and a RuntimeWarning
+    is issued if that leaves no coarse level at all, so the model is fitted
+    directly. Nl-1 and Nk-1 must be multiples of 2**(levels-1), e.g. 9x13 or
+    17x25 for 3 levels.
+
+    Requires the kd-tree to be initialized, and the correspondences are
+    assigned again at each level. Returns a list with the solver information
+    of each level, from the coarsest one, with the mesh size, mesh_scale and
+    time of the level added to it.'''
+    step = 1
+    while (step * 2 < 2**levels and
+           (self.Nl - 1) % (step * 2) == 0 and (self.Nk - 1) % (step * 2) == 0
+           and (self.Nl - 1) / (step * 2) + 1 >= min_size
+           and (self.Nk - 1) / (step * 2) + 1 >= min_size):
+      step *= 2
+    if step == 1 and levels > 1:
+      warnings.warn('fit_pyramid: the %dx%d mesh has no coarser level, '
+                    'fitting it directly' % (self.Nl, self.Nk),
+                    RuntimeWarning)
+
+    def fit_level(surf, mesh_scale_level):
+      t0 = time.time()
+      surf.assign_input_points()
+      surf.set_initial_guess(estimate_multipliers(
+        surf.pl0, surf.q, surf.U, surf.V, surf.UU, surf.VV, surf.Laplace,
+        mesh_scale_level, Gamma))
+      info = surf.fit(mesh_scale_level, Gamma, method)
+      info.update({'Nl': surf.Nl, 'Nk': surf.Nk,
+                   'mesh_scale': mesh_scale_level, 'time': time.time() - t0})
+      return info
+
+    pl = restrict_solution(self.pl0, self.Nl, self.Nk, step)
+    Nl = (self.Nl - 1) / step + 1
+    Nk = (self.Nk - 1) / step + 1
+    infos = []
+    while step > 1:
+      level = SurfaceModel(Nl, Nk, self.stencil)
+      level.q_data = self.q_data
+      level.xyz_tree = self.xyz_tree
+      level.workers = self.workers
+      level.set_initial_guess(pl)
+      infos.append(fit_level(level, mesh_scale * step))
+
+      step /= 2
+      Nl_new = (self.Nl - 1) / step + 1
+      Nk_new = (self.Nk - 1) / step + 1
+      pl = prolong_solution(level.pl0, Nl, Nk, Nl_new, Nk_new)
+      Nl, Nk = Nl_new, Nk_new
+
+    self.set_initial_guess(pl)
+    infos.append(fit_level(self, mesh_scale))
+    return infos
 
   def coordinates(self):
     return self.pl0.reshape(-1,3)[:self.Np]
 
 
+class SurfaceBatch:
+  '''Fits many SurfaceModel objects of the same size together. The models
+  are stacked and solved with batch_kkt_newton, so each sparse product and
+  factorization works over all the models at once, which avoids most of the
+  Python overhead of fitting small meshes one by one. The correspondences of
+  each model must be already assigned.'''
+
+  def __init__(self, models):
+    self.models = models
+    surf = models[0]
+    for m in models:
+      if (m.Nl, m.Nk, m.stencil) != (surf.Nl, surf.Nk, surf.stencil):
+        raise ValueError('All models in a batch must have the same size.')
+    self.U, self.V, self.UU, self.VV, self.Laplace = (surf.U, surf.V, surf.UU,
+                                                      surf.VV, surf.Laplace)
+
+  def fit(self, mesh_scale, Gamma, **kwargs):
+    '''Solves the system of every model starting from its pl0. mesh_scale
+    and Gamma can be a single value or a sequence with one value per model.
+    Returns the list of info dictionaries from batch_kkt_newton.'''
+    PL = array([m.pl0 for m in self.models])
+    Q = array([m.q for m in self.models])
+    PL, info = batch_kkt_newton(PL, Q, self.U, self.V, self.UU, self.VV,
+                                self.Laplace, mesh_scale, Gamma, **kwargs)
+    for m, pl in zip(self.models, PL):
+      m.pl0 = pl
+    return info
+
+class SurfaceTracker:
+  '''Fits a SurfaceModel to a sequence of frames, such as the disparity
+  images of a page being scanned continuously. The solution of each frame,
+  including the Lagrange multipliers, is the initial guess of the next one,
+  so small movements only need a couple of iterations. Before fitting, the rms
+  distance from the model points to their new correspondences is checked, and
+  if it is larger than turn_threshold * mesh_scale the page is assumed to have
+  been turned, and the model is initialized again from the point cloud.
+
+  The number of rounds, residual, elapsed time and whether the model was
+  reinitialized are kept for each frame at history.'''
+
+  def __init__(self, surf, mesh_scale, Gamma, method='leastsq',
+               turn_threshold=0.5, max_rounds=2, cold_rounds=10,
+               offset=None):
+    self.surf = surf
+    self.mesh_scale = mesh_scale
+    self.Gamma = Gamma
+    self.method = method
+    self.turn_threshold = turn_threshold
+    self.max_rounds = max_rounds
+    self.cold_rounds = cold_rounds
+    ## Displacement of the initial guess from the middle of the point cloud.
+    self.offset = zeros(3) if offset is None else offset
+    self.tracking = False
+    self.history = []
+
+  def reset(self):
+    '''Makes the next frame start from a new initial guess.'''
+    self.tracking = False
+
+  def process_frame(self, q_data, shape=None, intparam=None, pixel_index=None):
+    '''Fits the model to a new point cloud. If shape and intparam are given
+    the correspondences are found by projection, otherwise with a kd-tree.
+    pixel_index holds the pixels of the points, if only the valid ones are
+    given. Returns the record of this frame added to history.'''
+    t0 = time.time()
+    surf = self.surf
+    if shape is not None:
+      surf.initialize_projection(q_data, shape, intparam,
+                                 pixel_index=pixel_index)
+    else:
+      surf.initialize_kdtree(q_data)
+
+    reinitialized = not self.tracking
+    if self.tracking:
+      surf.assign_input_points()
+      jump = sqrt(((surf.coordinates() - surf.q) ** 2).sum(1).mean())
+      reinitialized = jump > self.turn_threshold * self.mesh_scale
+
+    if reinitialized:
+      ## Same procedure as a single capture: a rough fit without
+      ## regularization, then the final one.
+      surf.calculate_initial_guess(self.mesh_scale,
+                                   q_data.mean(0) + self.offset)
+      surf.q_index = None
+      surf.fit_icp(self.mesh_scale, 0.0, self.method, max_rounds=3)
+      info = surf.fit_icp(self.mesh_scale, self.Gamma, self.method,
+                          max_rounds=self.cold_rounds)
+    else:
+      info = surf.fit_icp(self.mesh_scale, self.Gamma, self.method,
+                          max_rounds=self.max_rounds)
+    self.tracking = True
+
+    record = {'rounds': info['rounds'], 'residual': info['residual'],
+              'reinitialized': reinitialized, 'time': time.time() - t0}
+    self.history.append(record)
+    return record
+
+  def latencies(self):
+    '''Returns an array with the processing time of each frame.'''
+    return array([r['time'] for r in self.history])
+
+
 ################################################################################
 ## Main function, for testing.
 if __name__ == '__main__':